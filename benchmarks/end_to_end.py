@@ -0,0 +1,133 @@
+# Offline end-to-end benchmark for the ABX action: runs handler against the mock vRA API and SMTP sink of
+# benchmarks/mock_vra.py for several deployment sizes, and reports the p50/p99 latency, API calls, render time
+# and message size of each size.
+# Usage: python benchmarks/end_to_end.py [--resources 1,10,100,2000] [--latency-ms 5] [--runs 20] [--rate-limit 20] [--cold] [--json]
+
+import argparse # command line options
+import contextlib # silences the action prints
+import io # silences the action prints
+import json # JSON report
+import os # paths
+import statistics # means of the runs
+import sys # import path of snippet
+import time # end-to-end latency
+
+repoDir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoDir)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock_vra # local vRA API and SMTP sink
+import snippet # the ABX action
+
+# events the benchmark can run, as eventType:eventTopicId
+events={
+    "create": ("CREATE_DEPLOYMENT", "deployment.request.post"),
+    "pending": ("CREATE_DEPLOYMENT", "deployment.request.pre"),
+    "update": ("UPDATE_DEPLOYMENT", "deployment.request.post"),
+    "destroy": ("DESTROY_DEPLOYMENT", "deployment.request.post")
+}
+
+# Secrets of the benchmark, in place of the ABX context
+class BenchmarkContext:
+    def getSecret(self, name):
+        return "benchmark"
+
+# Nearest-rank percentile of a list of numbers
+def percentile(values, percent):
+    ordered=sorted(values)
+    return ordered[max(0, min(len(ordered)-1, int(round(percent/100.0*len(ordered)+0.5))-1))]
+
+# Resets the state the action keeps between invocations, as in a cold container: caches, the pooled vRA session,
+# the SMTP connection and the circuit breaker (whose healthy state skips the about probe).
+def clear_caches():
+    for cache in (snippet.projectCache, snippet.propertyGroupCache, snippet.userCache, snippet.priceCache):
+        cache.clear()
+    snippet.logoParts.clear()
+    snippet.htmlTemplates.clear()
+    snippet.get_timezone.cache_clear()
+    snippet.convert_timestamp.cache_clear()
+    if snippet.vraSession is not None:
+        snippet.vraSession.close()
+        snippet.vraSession=None
+    snippet.smtpSession.close()
+    snippet.vraGuards.clear()
+
+# Runs one event several times against a deployment of resourceCount resources, returns the results of the size
+def run_size(resourceCount, options, smtpSink):
+    eventType, eventTopicId=events[options.event]
+    mock=mock_vra.MockVra(resourceCount, options.latency_ms/1000.0, smtpSink.server.server_address[1])
+    vraFqdn=mock.start()
+    try:
+        inputs=mock_vra.event_inputs(vraFqdn, eventType, eventTopicId)
+        inputs["metrics"]=True
+        inputs["resource_page_size"]=options.page_size
+        if options.rate_limit:
+            inputs["api_rate_limit"]=options.rate_limit
+        for run in range(options.warmup):
+            with contextlib.redirect_stdout(io.StringIO()):
+                snippet.handler(BenchmarkContext(), dict(inputs))
+        mock.take_calls()
+        smtpSink.take_messages()
+        latencies=[]
+        apiCalls=[]
+        renderTimes=[]
+        for run in range(options.runs):
+            if options.cold:
+                clear_caches()
+            start=time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                outputs=snippet.handler(BenchmarkContext(), dict(inputs))
+            latencies.append(time.perf_counter()-start)
+            apiCalls.append(sum(mock.take_calls().values()))
+            stages=outputs["metrics"]["stages"]
+            renderTimes.append(stages["render"]["seconds"] if "render" in stages else 0.0)
+        messages=smtpSink.take_messages()
+        if len(messages)!=options.runs:
+            raise RuntimeError("{0} messages reached the SMTP sink for {1} runs".format(len(messages), options.runs))
+    finally:
+        mock.stop()
+    return {
+        "resources": resourceCount,
+        "runs": options.runs,
+        "p50Ms": round(percentile(latencies, 50)*1000, 2),
+        "p99Ms": round(percentile(latencies, 99)*1000, 2),
+        "apiCalls": round(statistics.mean(apiCalls), 1),
+        "renderMs": round(percentile(renderTimes, 50)*1000, 2),
+        "messageBytes": max(messages) if messages else 0
+    }
+
+def main():
+    parser=argparse.ArgumentParser(description="Offline end-to-end benchmark of snippet.handler")
+    parser.add_argument("--resources", default="1,10,100,2000", help="comma separated deployment sizes, 1 to 2000 resources")
+    parser.add_argument("--latency-ms", type=float, default=5, help="latency of every mock API response in milliseconds")
+    parser.add_argument("--runs", type=int, default=20, help="measured invocations per deployment size")
+    parser.add_argument("--warmup", type=int, default=1, help="invocations before measuring, they fill the caches")
+    parser.add_argument("--event", choices=sorted(events), default="create", help="notification event to run")
+    parser.add_argument("--page-size", type=int, default=100, help="resource_page_size input of the action")
+    parser.add_argument("--rate-limit", type=float, help="api_rate_limit input of the action in queries per second, no limit by default")
+    parser.add_argument("--cold", action="store_true", help="clear the caches of the action before every run")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    options=parser.parse_args()
+    sizes=[int(size) for size in options.resources.split(",")]
+    if any(size < 1 or size > 2000 for size in sizes):
+        parser.error("deployment sizes must be between 1 and 2000 resources")
+
+    smtpSink=mock_vra.SmtpSink()
+    smtpSink.start()
+    try:
+        results=[run_size(size, options, smtpSink) for size in sizes]
+    finally:
+        snippet.smtpSession.close()
+        smtpSink.stop()
+
+    if options.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("event {0}, {1} runs per size, {2:g} ms API latency, {3} caches, API rate limit {4}".format(options.event, options.runs, options.latency_ms,
+        "cold" if options.cold else "warm", "{0:g}/s".format(options.rate_limit) if options.rate_limit else "none"))
+    print("{0:>9} {1:>10} {2:>10} {3:>10} {4:>10} {5:>13}".format("resources", "p50 ms", "p99 ms", "API calls", "render ms", "message bytes"))
+    for result in results:
+        print("{resources:>9} {p50Ms:>10.2f} {p99Ms:>10.2f} {apiCalls:>10} {renderMs:>10.2f} {messageBytes:>13}".format(**result))
+
+if __name__=="__main__":
+    main()
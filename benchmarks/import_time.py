@@ -0,0 +1,53 @@
+# Import-time benchmark for the ABX action: measures the cold start cost of "import snippet" in fresh
+# interpreters and fails when it is over the budget or when a module meant to be lazily imported is loaded.
+# Usage: python benchmarks/import_time.py [--budget-ms 150] [--runs 5]
+
+import argparse # command line options
+import json # results of the child interpreters
+import os # paths
+import statistics # median of the runs
+import subprocess # fresh interpreters for each run
+import sys # exit code
+
+repoDir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that only the paths using them may import
+lazyModules=["requests", "json2table", "pytz", "smtplib", "ssl", "email.mime.multipart", "email.mime.text", "email.mime.image"]
+
+# measured in the child interpreter: import time of snippet and the lazy modules it loaded
+childCode='''
+import json, sys, time
+start=time.perf_counter()
+import snippet
+elapsed=time.perf_counter()-start
+print(json.dumps({"seconds": elapsed, "loaded": [name for name in %r if name in sys.modules]}))
+''' % (lazyModules,)
+
+def measure(runs):
+    results=[]
+    for run in range(runs):
+        child=subprocess.run([sys.executable, "-c", childCode], cwd=repoDir, capture_output=True, text=True, check=True)
+        results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+    return results
+
+def main():
+    parser=argparse.ArgumentParser(description="Cold start import-time budget of snippet.py")
+    parser.add_argument("--budget-ms", type=float, default=150, help="maximum median import time in milliseconds")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to measure")
+    options=parser.parse_args()
+
+    results=measure(options.runs)
+    medianMs=statistics.median(result["seconds"] for result in results)*1000
+    loaded=sorted(set(name for result in results for name in result["loaded"]))
+    print("import snippet: median {0:.1f} ms over {1} runs (budget {2:.0f} ms)".format(medianMs, options.runs, options.budget_ms))
+    failed=False
+    if loaded:
+        print("FAIL: modules that should be imported lazily were loaded: "+", ".join(loaded))
+        failed=True
+    if medianMs > options.budget_ms:
+        print("FAIL: import time is over the budget")
+        failed=True
+    sys.exit(1 if failed else 0)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,250 @@
+# Local stand-ins for the services the ABX action talks to, used by the offline benchmarks:
+# MockVra serves the vRA API endpoints queried by snippet.py over HTTPS (self-signed certificate, the action does not
+# verify it) with a configurable latency and deployment size, SmtpSink accepts and counts the notification emails.
+
+import json # API responses
+import os # certificate files
+import shutil # temporary certificate directory
+import socketserver # SMTP sink
+import ssl # HTTPS for the mock API
+import subprocess # openssl for the self-signed certificate
+import tempfile # certificate directory
+import threading # servers run in background threads
+import time # simulated latency
+from collections import Counter # API calls per endpoint
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # mock API
+from urllib.parse import urlsplit, parse_qs # query paths and parameters
+
+# 1x1 transparent PNG used as the property group logo
+logoBase64="iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+
+# Property group of the benchmark: unauthenticated, unencrypted SMTP to the sink
+def property_group(smtpPort):
+    settings={
+        "platform_name": "Benchmark vRA",
+        "timeZone": "Europe/Madrid",
+        "smtp_server": "127.0.0.1",
+        "smtp_port": smtpPort,
+        "smtp_user": "benchmark",
+        "sender_email": "vra@benchmark.local",
+        "smtp_authenticated": False,
+        "smtp_connection_security": "none",
+        "logo": logoBase64,
+        "logo_company_width_pixels": 120,
+        "logo_company_height_pixels": 40,
+        "custom_property_display": ["nodeSize"]
+    }
+    return {name: {"const": value} for name, value in settings.items()}
+
+# Creates a self-signed certificate for 127.0.0.1 in a new directory, returns (directory, certFile, keyFile)
+def self_signed_certificate():
+    certDir=tempfile.mkdtemp(prefix="mock-vra-")
+    certFile=os.path.join(certDir, "cert.pem")
+    keyFile=os.path.join(certDir, "key.pem")
+    try:
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+            "-keyout", keyFile, "-out", certFile], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        shutil.rmtree(certDir, ignore_errors=True)
+        raise RuntimeError("openssl is needed to create the certificate of the mock vRA API: "+str(e))
+    return certDir, certFile, keyFile
+
+# Mock vRA API. One deployment with resourceCount resources (two vSphere machines for every NSX network), every
+# response is delayed by latency seconds. Request and price polls complete at once so runs measure the action itself.
+class MockVra:
+    def __init__(self, resourceCount=10, latency=0.0, smtpPort=25):
+        self.resourceCount=resourceCount
+        self.latency=latency
+        self.propertyGroup=property_group(smtpPort)
+        self.calls=Counter() # "METHOD endpoint" -> number of queries
+        self.lock=threading.Lock()
+        self.resources=[self.resource(i) for i in range(resourceCount)]
+        self.server=None
+        self.certDir=None
+
+    # Resource i of the deployment
+    def resource(self, i):
+        network=i%3==2
+        return {
+            "id": "resource-%05d" % i,
+            "name": "network-%d" % i if network else "Cloud_vSphere_Machine_%d" % i,
+            "type": "Cloud.NSX.Network" if network else "Cloud.vSphere.Machine",
+            "state": "OK",
+            "createdAt": "2021-12-22T10:%02d:%02d.123Z" % (i//60%60, i%60),
+            "lastUpdatedAt": "2021-12-22T11:00:00.000Z",
+            "properties": {"resourceName": "vm-%05d" % i, "cpuCount": 2, "totalMemoryMB": 4096}
+        }
+
+    # Details of a vSphere machine
+    def machine(self, resourceId):
+        return {"id": resourceId, "properties": {"address": "10.0.%d.%d" % (int(resourceId[-5:])//250, int(resourceId[-5:])%250+2),
+            "cpuCount": 2, "totalMemoryMB": 4096, "softwareName": "Ubuntu Linux (64-bit)",
+            "storage": {"disks": [{"name": "Hard disk 1", "type": "HDD", "capacityGb": 40}, {"name": "Hard disk 2", "type": "HDD", "capacityGb": 100}]}}}
+
+    # Deployment of the benchmark
+    def deployment(self, deploymentId, expand):
+        deployment={"id": deploymentId, "name": "benchmark-deployment", "description": "Offline benchmark", "status": "CREATE_SUCCESSFUL",
+            "createdAt": "2021-12-22T10:00:00.000Z", "lastUpdatedAt": "2021-12-22T11:00:00.000Z", "leaseExpireAt": "2022-01-22T10:00:00.000Z",
+            "createdBy": "benchmark", "ownedBy": "benchmark", "lastUpdatedBy": "benchmark", "project": {"id": "project-1", "name": "Benchmark"}}
+        if "resources" in expand:
+            deployment["resources"]=self.resources
+        return deployment
+
+    # Answers a query: returns (HTTP status, endpoint name, response body)
+    def route(self, method, path, query):
+        parts=path.strip("/").split("/")
+        if path=="/project-service/api/about":
+            return 200, "about", {"latestApiVersion": "2021-07-15"}
+        if path.startswith("/project-service/api/projects/"):
+            return 200, "projects/{id}", {"id": parts[-1], "properties": {"propertyGroup": "benchmark-notifications"}}
+        if path.startswith("/properties/api/property-groups"):
+            return 200, "property-groups", {"content": [{"name": query.get("name", ""), "properties": self.propertyGroup}]}
+        if path.startswith("/deployment/api/deployments/") and path.endswith("/resources"):
+            page=int(query.get("page", 0))
+            size=int(query.get("size", 20))
+            content=self.resources[page*size:(page+1)*size]
+            return 200, "deployments/{id}/resources", {"content": content, "totalElements": self.resourceCount,
+                "totalPages": (self.resourceCount+size-1)//size, "last": (page+1)*size >= self.resourceCount}
+        if path.startswith("/deployment/api/deployments/"):
+            return 200, "deployments/{id}", self.deployment(parts[-1], query.get("expand", ""))
+        if path.startswith("/deployment/api/resources/"):
+            return 200, "resources/{id}", self.machine(parts[-1])
+        if path.startswith("/deployment/api/requests/"):
+            return 200, "requests/{id}", {"id": parts[-1], "completedTasks": 4, "status": "IN_PROGRESS", "details": ""}
+        if path.startswith("/csp/gateway/am/api/users/"):
+            return 200, "users/{id}", {"user": {"email": "requestor@benchmark.local", "firstName": "Benchmark"}}
+        if "/upfront-prices" in path:
+            if method=="POST":
+                return 200, "upfront-prices", {"upfrontPriceId": "price-1"}
+            return 200, "upfront-prices/{id}", {"status": "SUCCESS", "dailyTotalPrice": 12.3456}
+        return 404, "unknown", {"message": "Not found: "+path}
+
+    # Starts the HTTPS server on a free local port, returns the host:port for the vra_fqdn input
+    def start(self):
+        mock=self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version="HTTP/1.1" # keep-alive, as the action pools its connections
+            disable_nagle_algorithm=True # headers and body are separate writes, Nagle and delayed ACKs would add ~40 ms to each response
+            def answer(self, method):
+                if self.headers.get("Content-Length"):
+                    self.rfile.read(int(self.headers["Content-Length"]))
+                url=urlsplit(self.path)
+                query={name: values[-1] for name, values in parse_qs(url.query).items()}
+                if mock.latency:
+                    time.sleep(mock.latency)
+                status, endpoint, body=mock.route(method, url.path, query)
+                with mock.lock:
+                    mock.calls[method+" "+endpoint]+=1
+                payload=json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            def do_GET(self):
+                self.answer("GET")
+            def do_POST(self):
+                self.answer("POST")
+            def log_message(self, format, *args):
+                pass
+        self.certDir, certFile, keyFile=self_signed_certificate()
+        tlsContext=ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        tlsContext.load_cert_chain(certFile, keyFile)
+        self.server=ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads=True
+        self.server.socket=tlsContext.wrap_socket(self.server.socket, server_side=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return "127.0.0.1:"+str(self.server.server_address[1])
+
+    # Number of queries since the last call, and resets the counters
+    def take_calls(self):
+        with self.lock:
+            calls=dict(self.calls)
+            self.calls.clear()
+        return calls
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.certDir:
+            shutil.rmtree(self.certDir, ignore_errors=True)
+
+# Minimal SMTP server that accepts every message and keeps the size of each one. Enough for smtplib without
+# authentication or TLS; a connection can carry several messages, like the persistent session of the action.
+class SmtpSink:
+    def __init__(self):
+        self.messages=[] # size in bytes of each received message
+        self.lock=threading.Lock()
+        self.server=None
+
+    def start(self):
+        sink=self
+        class Handler(socketserver.StreamRequestHandler):
+            disable_nagle_algorithm=True # one write per reply line, as for the mock API
+            def reply(self, line):
+                self.wfile.write((line+"\r\n").encode())
+            def handle(self):
+                self.reply("220 smtp-sink ready")
+                while True:
+                    line=self.rfile.readline()
+                    if not line:
+                        return
+                    command=line.decode("ascii", "replace").strip().upper()
+                    if command.startswith("EHLO"):
+                        self.wfile.write(b"250-smtp-sink\r\n250-8BITMIME\r\n250 SIZE 52428800\r\n")
+                    elif command.startswith("HELO") or command.startswith("MAIL") or command.startswith("RCPT") or command in ("RSET", "NOOP"):
+                        self.reply("250 OK")
+                    elif command=="DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        size=0
+                        while True:
+                            data=self.rfile.readline()
+                            if not data or data==b".\r\n":
+                                break
+                            size+=len(data)
+                        with sink.lock:
+                            sink.messages.append(size)
+                        self.reply("250 OK queued")
+                    elif command=="QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("502 Command not implemented")
+        self.server=socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads=True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    # Sizes of the messages received since the last call
+    def take_messages(self):
+        with self.lock:
+            messages=self.messages
+            self.messages=[]
+        return messages
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+# Event inputs of the action for the mock vRA API
+def event_inputs(vraFqdn, eventType="CREATE_DEPLOYMENT", eventTopicId="deployment.request.post", requestId="request-1"):
+    return {
+        "id": requestId,
+        "orgId": "org-1",
+        "projectId": "project-1",
+        "deploymentId": "deployment-1",
+        "userId": "benchmark:user-1",
+        "userName": "benchmark",
+        "bearerToken": "Bearer benchmark",
+        "vra_fqdn": vraFqdn,
+        "eventType": eventType,
+        "__metadata": {"eventTopicId": eventTopicId},
+        "actionName": "Create",
+        "requestType": "CATALOG",
+        "catalogItemId": "catalog-item-1",
+        "catalogItemVersion": "1",
+        "requestInputs": {"nodeSize": "small"},
+        "smtp_password": "smtp_password"
+    }
@@ -0,0 +1,171 @@
+# Batch replay of the ABX action: runs snippet.handler over a JSONL file of event inputs (one inputs dictionary per
+# line), to backfill notifications missed during an SMTP outage or to load-test the action.
+# Secrets come from a local provider instead of context.getSecret: a JSON file of name -> value, then the
+# ABX_SECRET_<NAME> environment variables.
+# Usage: python replay.py events.jsonl [--mode dry-run|render-only|send] [--workers 4] [--pool process|thread]
+#        [--secrets secrets.json] [--set bearerToken=...] [--json]
+# render-only leaves the digest, snapshot and metrics files alone, but still queries vRA: catalog requests pending
+# approval (CREATE_DEPLOYMENT pre) POST a new upfront price request unless their estimate is in the price cache.
+
+import argparse # command line options
+import contextlib # hides the action prints in thread workers
+import json # event inputs and report
+import os # secrets from the environment
+import sys # exit code
+import time # throughput
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor # worker pools
+
+# inputs every event needs before it can be replayed
+requiredInputs=["id", "orgId", "projectId", "deploymentId", "userId", "userName", "vra_fqdn", "bearerToken", "smtp_password", "__metadata"]
+
+# Local secret provider, stands in for the ABX context
+class LocalSecrets:
+    def __init__(self, secrets):
+        self.secrets=secrets
+
+    def getSecret(self, name):
+        if name in self.secrets:
+            return self.secrets[name]
+        environmentName="ABX_SECRET_"+"".join(character if character.isalnum() else "_" for character in name).upper()
+        if environmentName in os.environ:
+            return os.environ[environmentName]
+        raise KeyError("Secret "+name+" is not in the secrets file nor in "+environmentName)
+
+# Reads the events of a JSONL file, returns a list of (line number, inputs or None, parse error or None)
+def read_events(path):
+    events=[]
+    with open(path) as eventsFile:
+        for lineNumber, line in enumerate(eventsFile, 1):
+            if not line.strip():
+                continue
+            try:
+                inputs=json.loads(line)
+                if not isinstance(inputs, dict):
+                    raise ValueError("the line is not a JSON object")
+                events.append((lineNumber, inputs, None))
+            except ValueError as e:
+                events.append((lineNumber, None, "Invalid JSON: "+str(e)))
+    return events
+
+# Problems that keep an event from being replayed, empty when it is valid
+def validate_event(inputs, secrets):
+    problems=["missing input "+name for name in requiredInputs if name not in inputs]
+    if "__metadata" in inputs and "eventTopicId" not in inputs["__metadata"]:
+        problems.append("missing input __metadata.eventTopicId")
+    if "smtp_password" in inputs:
+        try:
+            secrets.getSecret(inputs["smtp_password"])
+        except KeyError as e:
+            problems.append(str(e.args[0]))
+    return problems
+
+# Hides the prints of the action in a worker process
+def silence_output():
+    sys.stdout=open(os.devnull, "w")
+
+# Replays one event in a worker; returns a result dictionary, never raises
+def replay_event(lineNumber, inputs, mode, secrets):
+    import snippet # the ABX action, imported by each worker process
+    result={"line": lineNumber, "id": inputs["id"] if "id" in inputs else "", "ok": False}
+    start=time.perf_counter()
+    context=LocalSecrets(secrets)
+    problems=validate_event(inputs, context)
+    if problems:
+        result["error"]="; ".join(problems)
+    elif mode=="dry-run":
+        result["ok"]=True
+    else:
+        inputs=dict(inputs)
+        if mode=="render-only":
+            # nothing is queued, spooled or written: no digest, no deployment snapshot update, no metrics line. Degraded
+            # notifications (degrade_when_unavailable) are rendered too, never sent.
+            inputs["render_only"]=True
+            inputs["digest_dir"]=None
+            inputs["snapshot_dir"]=None
+            inputs["metrics_file"]=None
+        try:
+            outputs=snippet.handler(context, inputs)
+            result["subject"]=outputs["messageSubject"]
+            if "rendered" in outputs:
+                result["ok"]=True
+                result["messageBytes"]=outputs["rendered"]["messageBytes"]
+            elif "delivered" in outputs:
+                result["ok"]=outputs["delivered"]
+                if not result["ok"]:
+                    result["error"]="The email was not delivered"
+            else:
+                result["ok"]=True # spooled in the outbox or queued in a digest
+        except SystemExit as e: # fatal errors of the action end with sys.exit
+            result["error"]=str(e.code)
+        except Exception as e:
+            result["error"]=type(e).__name__+": "+str(e)
+    result["seconds"]=round(time.perf_counter()-start, 4)
+    return result
+
+# Value of a --set option, JSON when it parses as JSON
+def parse_setting(setting):
+    name, separator, value=setting.partition("=")
+    if not separator:
+        raise argparse.ArgumentTypeError("expected name=value, got "+setting)
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+def main():
+    parser=argparse.ArgumentParser(description="Replay a JSONL file of event inputs through snippet.handler")
+    parser.add_argument("events", help="JSONL file with one inputs dictionary per line")
+    parser.add_argument("--mode", choices=["dry-run", "render-only", "send"], default="dry-run",
+        help="dry-run only validates the events, render-only queries vRA (including upfront price requests) and builds the emails "
+        "without sending them or touching the digest, snapshot and metrics files, send runs the whole action")
+    parser.add_argument("--workers", type=int, default=4, help="events replayed concurrently")
+    parser.add_argument("--pool", choices=["process", "thread"], default="process", help="run the workers as processes or threads")
+    parser.add_argument("--secrets", help="JSON file of secret name -> value")
+    parser.add_argument("--set", dest="settings", type=parse_setting, action="append", default=[], metavar="NAME=VALUE",
+        help="overrides an input in every event, like a fresh bearerToken; the value is parsed as JSON when possible")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the action")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    options=parser.parse_args()
+
+    secrets={}
+    if options.secrets:
+        with open(options.secrets) as secretsFile:
+            secrets=json.load(secretsFile)
+    events=read_events(options.events)
+    results=[{"line": lineNumber, "id": "", "ok": False, "error": error, "seconds": 0.0} for lineNumber, inputs, error in events if error]
+    valid=[(lineNumber, dict(inputs, **dict(options.settings))) for lineNumber, inputs, error in events if not error]
+
+    start=time.perf_counter()
+    workers=max(1, options.workers)
+    if options.pool=="process":
+        executor=ProcessPoolExecutor(max_workers=workers, initializer=None if options.verbose else silence_output)
+        output=contextlib.nullcontext()
+    else:
+        executor=ThreadPoolExecutor(max_workers=workers)
+        output=contextlib.nullcontext() if options.verbose else contextlib.redirect_stdout(open(os.devnull, "w")) # threads share sys.stdout
+    with output, executor:
+        futures=[executor.submit(replay_event, lineNumber, inputs, options.mode, secrets) for lineNumber, inputs in valid]
+        results.extend(future.result() for future in futures)
+    elapsed=time.perf_counter()-start
+    results.sort(key=lambda result: result["line"])
+
+    failures=[result for result in results if not result["ok"]]
+    report={
+        "mode": options.mode,
+        "events": len(results),
+        "succeeded": len(results)-len(failures),
+        "failed": len(failures),
+        "seconds": round(elapsed, 3),
+        "eventsPerSecond": round(len(valid)/elapsed, 2) if elapsed > 0 else 0.0,
+        "failures": failures
+    }
+    if options.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("{mode}: {events} events, {succeeded} succeeded, {failed} failed in {seconds} s ({eventsPerSecond} events/s)".format(**report))
+        for failure in failures:
+            print("  line {0} ({1}): {2}".format(failure["line"], failure["id"], failure["error"]))
+    sys.exit(1 if failures else 0)
+
+if __name__=="__main__":
+    main()
@@ -2,294 +2,1270 @@
 # Created by Guillermo Martinez and Dennis Gerolymatos 
 # Version 1.4 - 22.12.2021
 
+# requests, json2table, smtplib, ssl and the email.mime packages are imported by the functions using them, so a cold
+# ABX container only loads the modules of the path it runs (see benchmarks/import_time.py for the budget).
 import json # API query responses to json.
-import requests # query the API
-import smtplib # send email
+import re # HTML template compilation
 import sys # exit the script
-import pytz # time zone
-import ssl # SSL email
-from email.mime.text import MIMEText # mime objects on Email
-from email.mime.multipart import MIMEMultipart # emails with HTML content
-from json2table import convert # diccionaries to html
-from datetime import datetime #  current time
+import socket # SMTP connection errors
+import base64 # decode the logo
+import hashlib # logo versions
+import uuid # outbox message IDs
+import fcntl # locks on the local digest files
+from contextlib import contextmanager # file lock helper
+from datetime import datetime, timezone #  current time, UTC timestamps of the API
+from functools import lru_cache # time zones
+from concurrent.futures import ThreadPoolExecutor # concurrent API queries
+import time # polling delays and deadlines
+import random # jitter for the polling delays
+import os # local cache files
+import threading # locks for the shared caches
+import contextvars # metrics of the running invocation, also seen by its worker threads
+from collections import OrderedDict # LRU order of the caches
+from dataclasses import dataclass, field # typed settings from the property group
+
+smtpTimeout=30 # seconds for connecting to and talking with the SMTP server
+outboxMaxAttempts=6 # delivery attempts of a spooled message before it is moved to the dead letters
+outboxRetryDelay=30 # seconds before the first retry of a spooled message, doubled on each attempt
+outboxMaxRetryDelay=1800 # upper limit in seconds for the delay between two attempts
+outboxClaimTimeout=600 # seconds after which a message claimed by a crashed worker is queued again
+outboxWorkers=4 # concurrent SMTP connections used by drain_outbox
+defaultDigestWindow=300 # seconds the notifications of a requestor are collected in digest mode, override with digest_window_seconds
+digestClaimTimeout=600 # seconds after which a digest claimed by a stopped invocation is queued again
+
+# Shared HTTP session for the vRA API. It is kept at module level so warm ABX containers
+# reuse the pooled keep-alive connections (and TLS sessions) between invocations of handler.
+vraSession=None
+vraPoolSize=16 # max keep-alive connections kept open to the vRA appliance
+defaultMaxWorkers=8 # concurrent resource queries, override with the api_max_workers property
+pollTimeout=120 # seconds before giving up on a status poll, override with the poll_timeout_seconds input. Keep it well below the ABX action timeout (180 seconds by default).
+pollInitialDelay=0.5 # seconds before the first re-query of a status poll
+pollMaxDelay=8 # upper limit in seconds for the delay between two polls
+requestFinalStatus=("APPROVAL_PENDING","APPROVAL_REJECTED","SUCCESSFUL","FAILED","ABORTED") # request status that end the approval check
+propertyGroupCacheTtl=600 # seconds a project's property group and its content are reused
+propertyGroupCacheSize=64 # max projects / property groups kept in the caches
+userCacheTtl=3600 # seconds a requestor's email and first name are reused
+userCacheNegativeTtl=300 # seconds an unknown user is remembered as unknown
+userCacheSize=1024 # max users kept in the cache
+logoPartsSize=8 # logo MIME parts kept in memory, one per property group logo version
+priceCacheTtl=3600 # seconds a daily price estimate is reused for the same catalog item, version, project and inputs
+priceCacheSize=256 # max price estimates kept in the cache
+defaultResourcePageSize=100 # resources fetched per API query, override with the resource_page_size input
+defaultResourceTableMaxRows=500 # resources listed in the email, override with the resource_table_max_rows property
+defaultApiRateLimit=20.0 # vRA queries per second used when rate_limit_dir is set without api_rate_limit
+defaultApiRateBurst=40 # vRA queries allowed at once after an idle period, override with the api_rate_burst input
+breakerFailureThreshold=5 # consecutive failed vRA queries (connection errors, HTTP 429 and 5xx) that open the circuit
+breakerOpenSeconds=30 # seconds the circuit stays open, vRA is not queried meanwhile
+breakerHealthyTtl=60 # seconds after a successful vRA query during which the about probe is skipped
+breakerHealthyRefresh=5 # seconds between two updates of the last successful query time in the shared state
+apiPathIds=re.compile(r"/(deployments|resources|projects|requests|users|orgs|items|upfront-prices)/[^/]+") # IDs replaced in the API metrics paths
 
 def handler(context, inputs):
     # VARIABLES
 
     global apiVersion; apiVersion="2021-07-15" # tested with version 2021-07-15
+    metricsFile=inputs["metrics_file"] if "metrics_file" in inputs and inputs["metrics_file"] else None # optional JSON lines file for the metrics
+    metrics=Metrics(bool(metricsFile) or ("metrics" in inputs and bool(inputs["metrics"]))) # per-stage metrics, off unless requested
+    invocationMetrics.set(metrics)
+    invocationSettings.set(InvocationSettings.from_inputs(inputs)) # cache and rate limit settings, never from the previous invocation of a warm container
    
     # Creates a dictionary with all neccesary data from VRa API and context inputs
-    depInfoAndRes=create_dictionary(inputs)
-    
-    # calls generate_html function to populate the HTML body
-    html=generate_html(inputs,depInfoAndRes)
+    try:
+        with metrics.stage("collect"):
+            depInfoAndRes=create_dictionary(inputs)
+    except VraUnavailableError as e:
+        if "degrade_when_unavailable" in inputs and inputs["degrade_when_unavailable"]:
+            # degraded mode: a minimal email built from the cached settings and requestor
+            return send_degraded_notification(context, inputs, str(e))
+        sys.exit("Error: "+str(e))
     
-    # calls the function for sending the email.
-    send_email(context,inputs,html,depInfoAndRes)
-
     outputs={}
-    outputs['depInfoAndRes']=depInfoAndRes
-    outputs['messageSubject']=depInfoAndRes['status']+" - Status of deployment "+depInfoAndRes["name"]+" by "+depInfoAndRes['proGrpContent']['platform_name']['const'] # Subject for the notification
+    if "digest_dir" in inputs and inputs["digest_dir"]:
+        # digest mode: the notification is added to the requestor's digest, sent once its window is over
+        outputs['digest']=queue_digest(context, inputs, depInfoAndRes)
+    else:
+        # calls generate_html function to populate the HTML body
+        html=generate_html(inputs,depInfoAndRes)
+
+        # sends the email, or spools it in outbox mode
+        message=build_message(html, depInfoAndRes.config, depInfoAndRes.requestorEmail, message_subject(depInfoAndRes))
+        if "render_only" in inputs and inputs["render_only"]:
+            # render-only mode: the message is built but not sent
+            outputs['rendered']={"htmlBytes":len(html), "messageBytes":len(message.as_bytes())}
+        else:
+            outputs.update(dispatch_message(context, inputs, depInfoAndRes.config, depInfoAndRes.requestorEmail, message))
+
+    # trimmed projection of the deployment, the whole payload with every resource and the property group with full_outputs
+    fullOutputs="full_outputs" in inputs and bool(inputs["full_outputs"])
+    outputs['depInfoAndRes']=depInfoAndRes.full_payload() if fullOutputs else depInfoAndRes.projection()
+    outputs['messageSubject']=message_subject(depInfoAndRes) # Subject for the notification
+    if metrics.enabled:
+        outputs['metrics']=metrics.report()
+        if metricsFile:
+            metrics.write(metricsFile, {"eventId":inputs["id"] if "id" in inputs else "", "deploymentId":inputs["deploymentId"],
+                "eventType":inputs["eventType"] if "eventType" in inputs else "EXPIRE_NOTIFICATION"})
     return outputs
 
+# Returns the shared API session, creating the connection pool on first use.
+def get_vra_session():
+    global vraSession
+    if vraSession is None:
+        import requests # query the API
+        from requests.adapters import HTTPAdapter # connection pooling for the API session
+        vraSession=requests.Session()
+        vraSession.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=vraPoolSize))
+        vraSession.verify=False
+    return vraSession
+
+# Returns the time zone of a name, looked up once per process. Uses the standard zoneinfo module, falling back to
+# pytz (and its bundled database) on Python versions without it or on systems without the tzdata of the zone.
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    try:
+        from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+    except ImportError:
+        import pytz # time zone
+        return pytz.timezone(name)
+    try:
+        return ZoneInfo(name)
+    except ZoneInfoNotFoundError:
+        import pytz # time zone
+        return pytz.timezone(name)
+
+# Converts an ISO-8601 timestamp of the API (UTC, like "2021-12-22T10:00:00.123Z") to a local time string.
+# Fractional seconds are dropped; the results are cached as many resources share the same timestamps.
+@lru_cache(maxsize=4096)
+def convert_timestamp(timestamp, localTZ):
+    if not timestamp:
+        return ""
+    offset=timestamp[19:].lstrip(".0123456789") # what follows the seconds and their fraction: "Z", "+01:00" or nothing
+    parsed=datetime.fromisoformat(timestamp[:19]+("" if offset in ("", "Z", "z") else offset))
+    if parsed.tzinfo is None:
+        parsed=parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(localTZ).strftime("%Y-%m-%d %H:%M:%S")
+
+# Converts a batch of timestamps of the API to local time strings; the time zone (a name or a tzinfo) is resolved once.
+def format_timestamps(timestamps, timeZone):
+    localTZ=get_timezone(timeZone) if isinstance(timeZone, str) else timeZone
+    return [convert_timestamp(timestamp, localTZ) for timestamp in timestamps]
+
+# Timings and counters of the stages of an invocation: API queries (duration, bytes, HTTP status), the resource loop,
+# rendering, MIME building, SMTP sending and status polls. Disabled by default, the hooks then only check a flag.
+class Metrics:
+    def __init__(self, enabled=False):
+        self.lock=threading.Lock()
+        self.enabled=enabled
+        self.started=time.monotonic()
+        self.stages={} # stage name -> {"count", "seconds", "bytes"}
+        self.api={} # "METHOD path" -> {"count", "seconds", "bytesSent", "bytesReceived", "status": {code: count}}
+        self.polls={} # poll name -> {"polls", "seconds", "timedOut"}
+
+    # Start time for add_stage, None when disabled
+    def clock(self):
+        return time.monotonic() if self.enabled else None
+
+    # Adds the time since started (from clock) and the bytes produced to a stage
+    def add_stage(self, name, started, bytesCount=0):
+        if started is None:
+            return
+        seconds=time.monotonic()-started
+        with self.lock:
+            stage=self.stages.setdefault(name, {"count":0, "seconds":0.0, "bytes":0})
+            stage["count"]+=1
+            stage["seconds"]+=seconds
+            stage["bytes"]+=bytesCount
+
+    # Times the enclosed block as a stage; the bytes produced can be set in the yielded dict
+    @contextmanager
+    def stage(self, name):
+        started=self.clock()
+        stageBytes={"bytes":0}
+        try:
+            yield stageBytes
+        finally:
+            self.add_stage(name, started, stageBytes["bytes"])
+
+    # Records one API query, the IDs of the path are replaced so the queries of an endpoint add up
+    def add_api_call(self, method, path, started, statusCode, bytesSent, bytesReceived):
+        seconds=time.monotonic()-started
+        endpoint=method+" "+apiPathIds.sub(r"/\1/{id}", path)
+        with self.lock:
+            call=self.api.setdefault(endpoint, {"count":0, "seconds":0.0, "bytesSent":0, "bytesReceived":0, "status":{}})
+            call["count"]+=1
+            call["seconds"]+=seconds
+            call["bytesSent"]+=bytesSent
+            call["bytesReceived"]+=bytesReceived
+            call["status"][str(statusCode)]=call["status"].get(str(statusCode), 0)+1
+
+    # Records the statistics of a status poll
+    def add_poll(self, name, pollStats):
+        if self.enabled:
+            with self.lock:
+                self.polls[name]=pollStats
+
+    # Report of the invocation for the handler outputs
+    def report(self):
+        with self.lock:
+            stages={name: {"count":stage["count"], "seconds":round(stage["seconds"], 4), "bytes":stage["bytes"]} for name, stage in self.stages.items()}
+            endpoints={endpoint: dict(call, seconds=round(call["seconds"], 4), status=dict(call["status"])) for endpoint, call in self.api.items()}
+            status={}
+            for call in self.api.values():
+                for code, count in call["status"].items():
+                    status[code]=status.get(code, 0)+count
+            return {
+                "totalSeconds": round(time.monotonic()-self.started, 4),
+                "stages": stages,
+                "api": {
+                    "calls": sum(call["count"] for call in self.api.values()),
+                    "seconds": round(sum(call["seconds"] for call in self.api.values()), 4),
+                    "bytesSent": sum(call["bytesSent"] for call in self.api.values()),
+                    "bytesReceived": sum(call["bytesReceived"] for call in self.api.values()),
+                    "status": status,
+                    "endpoints": endpoints
+                },
+                "polls": dict(self.polls)
+            }
+
+    # Appends the report as one JSON line; a single write on a file opened for appending, so concurrent actions don't interleave.
+    def write(self, path, fields):
+        line=json.dumps(dict(fields, time=datetime.now(timezone.utc).isoformat(), **self.report()))+"\n"
+        try:
+            fd=os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print("Could not write the metrics to "+path+": "+str(e))
+
+# Metrics of the running invocation. Concurrent invocations in one process (like replay.py --pool thread) each set
+# their own; the default one is disabled.
+invocationMetrics=contextvars.ContextVar("invocationMetrics", default=Metrics())
+
+def current_metrics():
+    return invocationMetrics.get()
+
+# Wraps function to run in a copy of the caller's context, so the worker threads of an invocation record its metrics
+def in_context(function):
+    context=contextvars.copy_context()
+    return lambda *args: context.copy().run(function, *args)
+
+# Cache and rate limit settings of an invocation, from its inputs. Kept in a context variable like the metrics, so
+# concurrent invocations in one process do not overwrite each other's settings and their worker threads see them.
+@dataclass(frozen=True)
+class InvocationSettings:
+    cacheDir: str=None # directory to keep the caches across cold starts, from the cache_dir input. Caches stay in memory only when empty.
+    rateLimitDir: str=None # directory of the rate limiter and circuit breaker state shared by the actions of a node, from the rate_limit_dir input. In memory only when empty.
+    apiRateLimit: float=None # vRA queries per second for all the actions of a node, from the api_rate_limit input. No limit when empty.
+    apiRateBurst: float=defaultApiRateBurst
+
+    @classmethod
+    def from_inputs(cls, inputs):
+        rateLimitDir=inputs["rate_limit_dir"] if "rate_limit_dir" in inputs and inputs["rate_limit_dir"] else None
+        return cls(
+            cacheDir=inputs["cache_dir"] if "cache_dir" in inputs and inputs["cache_dir"] else None,
+            rateLimitDir=rateLimitDir,
+            apiRateLimit=float(inputs["api_rate_limit"]) if "api_rate_limit" in inputs and inputs["api_rate_limit"] else (defaultApiRateLimit if rateLimitDir else None), # the limiter is opt-in
+            apiRateBurst=float(inputs["api_rate_burst"]) if "api_rate_burst" in inputs and inputs["api_rate_burst"] else defaultApiRateBurst
+        )
+
+invocationSettings=contextvars.ContextVar("invocationSettings", default=InvocationSettings())
+
+def current_settings():
+    return invocationSettings.get()
+
+# Raised when vRA can not be queried: the circuit is open or the query failed to connect.
+class VraUnavailableError(Exception):
+    pass
+
+# JSON state shared by the actions of a node, read and changed under a file lock in the stateDir directory (the
+# rate_limit_dir input). Kept in memory (shared by the invocations of a warm container only) without stateDir.
+class SharedState:
+    def __init__(self, name):
+        self.name=name
+        self.memory={}
+        self.lock=threading.Lock()
+
+    # Calls change(state) under the lock and saves the state afterwards when change modified it, returns what change
+    # returns. Read-only changes (a closed circuit without rate limit, a recent success) do not rewrite the file.
+    def update(self, change, stateDir=None):
+        if not stateDir:
+            with self.lock:
+                return change(self.memory)
+        os.makedirs(stateDir, exist_ok=True)
+        path=os.path.join(stateDir, self.name+".json")
+        with file_lock(path+".lock"):
+            try:
+                state=read_json(path) or {}
+            except ValueError:
+                state={} # a damaged state file starts over
+            before=dict(state)
+            result=change(state)
+            if state!=before:
+                write_json_atomic(path, state)
+        return result
+
+# Rate limiter and circuit breaker of a vRA instance, both kept in one shared state so a query reads and changes it
+# once before it is sent (admit) and once after (record).
+# The rate limit is a token bucket shared by the actions querying the same vRA: apiRateLimit tokens per second, at most
+# apiRateBurst saved, both from the settings of the invocation. The circuit opens after breakerFailureThreshold
+# consecutive failed queries and stays open for breakerOpenSeconds; the next query after that closes it again when
+# it succeeds, or reopens it.
+class VraGuard:
+    def __init__(self, name):
+        self.state=SharedState(name)
+
+    # Waits until a token is available and takes it, unless the circuit is open. Returns the seconds the circuit
+    # stays open, 0 when vRA can be queried.
+    def admit(self, settings):
+        while True:
+            openFor, wait=self.state.update(lambda state: self.check(state, settings.apiRateLimit, settings.apiRateBurst), settings.rateLimitDir)
+            if openFor>0 or wait<=0:
+                return openFor
+            time.sleep(wait)
+
+    # Checks the circuit and takes a token from the state when rate is set. Returns (seconds the circuit stays open,
+    # seconds until the next token), or (0, 0) when a token was taken or there is no rate limit.
+    def check(self, state, rate, burst):
+        now=time.time()
+        if "openUntil" in state and state["openUntil"]>now:
+            return state["openUntil"]-now, 0
+        if not rate:
+            return 0, 0
+        tokens=state["tokens"]+max(0.0, now-state["updated"])*rate if "tokens" in state else burst
+        tokens=min(tokens, burst)
+        state["updated"]=now
+        if tokens>=1:
+            state["tokens"]=tokens-1
+            return 0, 0
+        state["tokens"]=tokens
+        return 0, (1-tokens)/rate
+
+    # Whether vRA answered a query recently and no query failed since, the connection test can then be skipped
+    def healthy(self, stateDir):
+        return self.state.update(lambda state: "lastSuccess" in state and state["failures"]==0
+            and time.time()-state["lastSuccess"] < breakerHealthyTtl, stateDir)
+
+    # Records the outcome of a query. The time of the last success is refreshed every breakerHealthyRefresh seconds
+    # only, so a run of successful queries does not rewrite the state.
+    def record(self, succeeded, stateDir):
+        def change(state):
+            now=time.time()
+            if succeeded:
+                state["failures"]=0
+                state.pop("openUntil", None)
+                if "lastSuccess" not in state or now-state["lastSuccess"] >= breakerHealthyRefresh:
+                    state["lastSuccess"]=now
+            else:
+                state["failures"]=state["failures"]+1 if "failures" in state else 1
+                if state["failures"]>=breakerFailureThreshold:
+                    state["openUntil"]=now+breakerOpenSeconds
+        self.state.update(change, stateDir)
+
+vraGuards={} # vRA host -> VraGuard
+vraGuardsLock=threading.Lock()
+
+# Returns the rate limiter and circuit breaker of a vRA instance
+def get_vra_guard(vraUrl):
+    with vraGuardsLock:
+        if vraUrl not in vraGuards:
+            vraGuards[vraUrl]=VraGuard("vra-"+re.sub(r"[^\w.-]", "_", vraUrl))
+        return vraGuards[vraUrl]
+
+# Client for the VRa API. Builds the common headers once and sends every query through the shared session, with the
+# rate limit settings of the invocation that created it.
+class VraClient:
+    def __init__(self, vraUrl, bearer):
+        self.settings=current_settings()
+        self.host=vraUrl # vRA instance, part of the keys of the shared caches
+        self.baseUrl='https://'+vraUrl
+        self.headers={"Accept":"application/json","Content-Type":"application/json", "Authorization":bearer} # common header for all the API queries.
+        self.session=get_vra_session()
+        self.guard=get_vra_guard(vraUrl)
+
+    def get(self, path, params=None):
+        return self.request("GET", path, params)
+
+    def post(self, path, body, params=None):
+        return self.request("POST", path, params, data=json.dumps(body))
+
+    def request(self, method, path, params=None, data=None):
+        global apiVersion
+        query={"apiVersion":apiVersion} # every query is pinned to the tested API version
+        if params:
+            query.update(params)
+        openFor=self.guard.admit(self.settings) # rate limit shared with the other actions of the node
+        if openFor>0:
+            raise VraUnavailableError("vRA API is unavailable, its circuit is open for {0:.0f} more seconds".format(openFor))
+        import requests # query the API
+        started=time.monotonic()
+        try:
+            response=self.session.request(method, self.baseUrl+path, params=query, data=data, headers=self.headers, verify=False)
+        except requests.RequestException as e:
+            self.guard.record(False, self.settings.rateLimitDir)
+            raise VraUnavailableError("vRA API query "+path+" failed: "+str(e)) from e
+        self.guard.record(response.status_code!=429 and response.status_code<500, self.settings.rateLimitDir)
+        metrics=current_metrics()
+        if metrics.enabled:
+            metrics.add_api_call(method, path, started, response.status_code, len(data) if data else 0, len(response.content))
+        return response
+
+# Builds the API client for the vRA instance and bearer token in the context inputs
+def vra_client(inputs):
+    return VraClient(inputs["vra_fqdn"], inputs['bearerToken'])
+
+# Queries the properties of each resource ID with a bounded number of workers, keeping the order of resourceIds.
+def get_vm_details(vraApi, resourceIds, maxWorkers):
+    if not resourceIds:
+        return []
+    maxWorkers=max(1, min(maxWorkers, vraPoolSize, len(resourceIds))) # never more workers than pooled connections
+    def fetch(resourceId):
+        return vraApi.get('/deployment/api/resources/' + resourceId).json()["properties"]
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        return list(executor.map(in_context(fetch), resourceIds))
+
+# Keeps only the fields of a deployment resource used by the notification, so a page of resources stays small.
+def project_resource(resource):
+    properties=resource["properties"] if "properties" in resource else {}
+    return {
+        "id": resource["id"],
+        "name": resource["name"] if "name" in resource else "",
+        "type": resource["type"],
+        "state": resource["state"] if "state" in resource else "",
+        "createdAt": resource["createdAt"] if "createdAt" in resource else "",
+        "lastUpdatedAt": resource["lastUpdatedAt"] if "lastUpdatedAt" in resource else "",
+        "properties": {"resourceName": properties["resourceName"]} if "resourceName" in properties else {}
+    }
+
+# Gets one page of the resources of a deployment, projected to the used fields.
+# Returns {"resources", "last"}, or None when the resources endpoint can not be used for the deployment.
+def get_resource_page(vraApi, deploymentId, page, pageSize):
+    response=vraApi.get('/deployment/api/deployments/' + deploymentId + '/resources', {'page':page, 'size':pageSize})
+    if response.status_code!=200:
+        print("Resources of the deployment can not be paged [HTTP {0}]".format(response.status_code))
+        return None
+    resourcePage=response.json()
+    last=resourcePage["last"] if "last" in resourcePage else page+1 >= resourcePage.get("totalPages", 1)
+    return {"resources":[project_resource(resource) for resource in resourcePage["content"]], "last":last or not resourcePage["content"]}
+
+# Yields the resources of a deployment one page at a time, so only a page of the API response is held in memory.
+# firstPage is the already fetched page 0, if any. Deployments whose resources can not be paged (deleted ones for
+# example) fall back to the deployment expanded with its resources.
+def iter_resource_pages(vraApi, deploymentId, pageSize, firstPage=None):
+    page=0
+    resourcePage=firstPage if firstPage is not None else get_resource_page(vraApi, deploymentId, page, pageSize)
+    if resourcePage is None:
+        deployment=vraApi.get('/deployment/api/deployments/' + deploymentId, {'deleted':'true','expand':'resources'}).json()
+        yield [project_resource(resource) for resource in deployment["resources"]]
+        return
+    yield resourcePage["resources"]
+    while not resourcePage["last"]:
+        page+=1
+        resourcePage=get_resource_page(vraApi, deploymentId, page, pageSize)
+        if resourcePage is None:
+            sys.exit("Error: Page "+str(page)+" of the deployment resources could not be read")
+        yield resourcePage["resources"]
+
+# Snapshot file of a deployment in the snapshot directory
+def snapshot_path(snapshotDir, deploymentId):
+    return os.path.join(snapshotDir, re.sub(r"[^\w.-]", "_", deploymentId)+".json")
+
+# Reads the resources of the last notification of a deployment: resource ID -> name, lastUpdatedAt and details.
+# None when the deployment has no snapshot yet.
+def load_snapshot(snapshotDir, deploymentId):
+    try:
+        with open(snapshot_path(snapshotDir, deploymentId)) as snapshotFile:
+            return json.load(snapshotFile)["resources"]
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        print("Ignoring unreadable snapshot of deployment "+deploymentId+": "+str(e))
+        return None
+
+# Writes the snapshot of a deployment atomically, a failure only costs the next update its full queries.
+def save_snapshot(snapshotDir, deploymentId, resources):
+    try:
+        os.makedirs(snapshotDir, exist_ok=True)
+        write_json_atomic(snapshot_path(snapshotDir, deploymentId), {"savedAt":time.time(), "resources":resources})
+    except (OSError, TypeError, ValueError) as e:
+        print("Could not write the snapshot of deployment "+deploymentId+": "+str(e))
+
+# Removes the snapshot of a deleted deployment.
+def delete_snapshot(snapshotDir, deploymentId):
+    try:
+        os.remove(snapshot_path(snapshotDir, deploymentId))
+    except FileNotFoundError:
+        pass
+
+# Poll deadline of an invocation: the poll_timeout_seconds input, or pollTimeout
+def poll_timeout(inputs):
+    return float(inputs["poll_timeout_seconds"]) if "poll_timeout_seconds" in inputs and inputs["poll_timeout_seconds"] else pollTimeout
+
+# Polls fetch() until isDone(result) is true or the deadline is reached, waiting with exponential backoff and jitter
+# between queries. A result already at hand can be passed as first to save one query.
+# Returns the last result and a dictionary with the number of polls, the elapsed seconds and whether it timed out.
+def poll_until(fetch, isDone, first=None, timeout=None, initialDelay=None, maxDelay=None, name="poll"):
+    timeout=pollTimeout if timeout is None else timeout
+    delay=pollInitialDelay if initialDelay is None else initialDelay
+    maxDelay=pollMaxDelay if maxDelay is None else maxDelay
+    start=time.monotonic()
+    deadline=start+timeout
+    polls=0
+    result=first
+    if result is None:
+        result=fetch()
+        polls+=1
+    while not isDone(result):
+        remaining=deadline-time.monotonic()
+        if remaining<=0:
+            break
+        time.sleep(min(remaining, delay*random.uniform(0.5, 1.0))) # jitter keeps concurrent actions from polling in lockstep
+        delay=min(delay*2, maxDelay)
+        result=fetch()
+        polls+=1
+    pollStats={"polls":polls, "seconds":round(time.monotonic()-start, 3), "timedOut":not isDone(result)}
+    current_metrics().add_poll(name, pollStats)
+    return result, pollStats
+
+# Cache with a time to live and a maximum size (least recently used entries are evicted first), shared by all the
+# invocations in a warm container. When the invocation sets cache_dir, the entries are also written to <cache_dir>/<name>.json so a
+# cold container can start from them; encode/decode convert the values from and to JSON friendly objects.
+class TTLCache:
+    def __init__(self, name, ttl, maxSize, encode=None, decode=None):
+        self.name=name
+        self.ttl=ttl
+        self.maxSize=maxSize
+        self.encode=encode or (lambda value: value)
+        self.decode=decode or (lambda value: value)
+        self.entries=OrderedDict() # key -> (expiry epoch seconds, value)
+        self.lock=threading.Lock()
+        self.loadedFrom=None
+
+    # cache file in the cache_dir of the running invocation, None when it has none
+    def file_path(self):
+        cacheDir=current_settings().cacheDir
+        return os.path.join(cacheDir, self.name+".json") if cacheDir else None
+
+    def get(self, key):
+        with self.lock:
+            self.load()
+            if key not in self.entries:
+                return None
+            expiry, value=self.entries[key]
+            if expiry < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.load()
+            self.entries[key]=(time.time()+(self.ttl if ttl is None else ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+            self.save()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.save()
+
+    # reads the cache file once per cache directory, entries already in memory win
+    def load(self):
+        path=self.file_path()
+        if path is None or path==self.loadedFrom:
+            return
+        self.loadedFrom=path
+        try:
+            with open(path) as cacheFile:
+                stored=json.load(cacheFile)
+            for key, (expiry, value) in stored.items():
+                if key not in self.entries and expiry >= time.time():
+                    self.entries[key]=(expiry, self.decode(value))
+        except (OSError, ValueError, TypeError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print("Ignoring unreadable cache file "+path+": "+str(e))
+
+    # writes the cache file atomically, a failure only costs the next cold start a query
+    def save(self):
+        path=self.file_path()
+        if path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmpPath=path+".%d.tmp" % os.getpid()
+            with open(tmpPath, "w") as cacheFile:
+                json.dump({key:(expiry, self.encode(value)) for key,(expiry, value) in self.entries.items()}, cacheFile)
+            os.replace(tmpPath, path)
+        except (OSError, TypeError, ValueError) as e:
+            print("Could not write cache file "+path+": "+str(e))
+
+# Settings of the notification, parsed and validated once from the property group content.
+@dataclass
+class NotificationConfig:
+    content: dict # raw property group properties, as returned by the API
+    platformName: str
+    timeZone: str
+    smtpServer: str
+    smtpPort: int
+    smtpUser: str
+    senderEmail: str
+    smtpAuthenticated: bool
+    smtpSecurity: str # SSL, starttls or none
+    logo: str=" "
+    logoWidth: object=" "
+    logoHeight: object=" "
+    customPropertyDisplay: list=field(default_factory=list)
+    apiMaxWorkers: int=defaultMaxWorkers
+    resourceTableMaxRows: int=defaultResourceTableMaxRows
+
+    # builds the settings from the property group properties, exits when a mandatory property is missing or invalid
+    @classmethod
+    def from_content(cls, content):
+        def const(name, default=None):
+            return content[name]['const'] if name in content and 'const' in content[name] else default
+        required=["platform_name","timeZone","smtp_server","smtp_port","smtp_user","sender_email","smtp_authenticated","smtp_connection_security"]
+        missing=[name for name in required if const(name) is None]
+        if missing:
+            sys.exit("Error: Property group is missing the properties: "+", ".join(missing))
+        try:
+            get_timezone(const("timeZone"))
+            config=cls(
+                content=content,
+                platformName=str(const("platform_name")),
+                timeZone=const("timeZone"),
+                smtpServer=const("smtp_server"),
+                smtpPort=int(const("smtp_port")),
+                smtpUser=const("smtp_user"),
+                senderEmail=const("sender_email"),
+                smtpAuthenticated=const("smtp_authenticated") in (True, "true", "True", 1),
+                smtpSecurity=const("smtp_connection_security") if const("smtp_connection_security") in ("SSL","starttls") else "none",
+                logo=const("logo", " "),
+                logoWidth=const("logo_company_width_pixels", " "),
+                logoHeight=const("logo_company_height_pixels", " "),
+                customPropertyDisplay=list(const("custom_property_display", [])),
+                apiMaxWorkers=int(const("api_max_workers", defaultMaxWorkers)),
+                resourceTableMaxRows=int(const("resource_table_max_rows", defaultResourceTableMaxRows)))
+        except (ValueError, TypeError, KeyError) as e: # unknown time zones raise a KeyError
+            sys.exit("Error: Invalid property group settings: "+str(e))
+        return config
+
+# Dataclasses with __slots__ where the Python version supports them, for the models kept per resource.
+slotted=dataclass(slots=True) if sys.version_info >= (3, 10) else dataclass
+
+# Disk of a vSphere machine
+@slotted
+class Disk:
+    name: str
+    type: str
+    capacityGb: object
+
+# Resource of a deployment, with the fields listed in the resources table. The machine details stay None for
+# resources which are not vSphere machines.
+@slotted
+class Resource:
+    name: str
+    type: str
+    state: str
+    startedAt: str
+    ipAddress: object=None
+    cpuCount: object=None
+    totalMemoryMB: object=None
+    operatingSystem: object=None
+    disks: tuple=()
+
+    # Rows of the resource in the resources table, also the format of the snapshots and of the full outputs
+    def details(self):
+        details={"Name": self.name, "Type": self.type, "State": self.state, "started At": self.startedAt}
+        if self.ipAddress is not None:
+            details["IP Address"]=self.ipAddress
+            details["CPU count"]=self.cpuCount
+            details["Total Memory MB"]=self.totalMemoryMB
+            details["Operating System"]=self.operatingSystem
+        for j, disk in enumerate(self.disks):
+            details["disk "+str(j)]={"Name": disk.name, "Type": disk.type, "Capacity GB": disk.capacityGb}
+        return details
+
+    # Resource of the rows returned by details
+    @classmethod
+    def from_details(cls, details):
+        disks=[]
+        while "disk "+str(len(disks)) in details:
+            disk=details["disk "+str(len(disks))]
+            disks.append(Disk(disk["Name"], disk["Type"], disk["Capacity GB"]))
+        return cls(details["Name"], details["Type"], details["State"], details["started At"], details.get("IP Address"),
+            details.get("CPU count"), details.get("Total Memory MB"), details.get("Operating System"), tuple(disks))
+
+# Deployment information, request and requestor of a notification, filled in by create_dictionary
+@slotted
+class Deployment:
+    id: str=" "
+    name: str=" "
+    description: str=" "
+    status: str=" "
+    createdAt: str=""
+    leaseExpireAt: str=""
+    lastUpdatedAt: str=""
+    createdBy: str=" "
+    ownedBy: str=" "
+    lastUpdatedBy: str=" "
+    projectName: str=" "
+    requestDetails: str=""
+    requestStatus: str=""
+    requestorEmail: str=""
+    requestorFirstName: str=""
+    resources: dict=field(default_factory=dict) # resource name -> Resource
+    changes: dict=None # added, changed and removed resource names in snapshot mode
+    pollStats: dict=None
+    config: NotificationConfig=None # parsed settings of the property group
+    priceEstimate: object=None # future of the daily price estimate
+
+    # Trimmed projection for the handler outputs: the fields of the notification, without the resources
+    def projection(self):
+        projection={"id": self.id, "name": self.name, "description": self.description, "status": self.status,
+            "createdAt": self.createdAt, "leaseExpireAt": self.leaseExpireAt, "requestDetails": self.requestDetails,
+            "requestStatus": self.requestStatus, "requestorEmail": self.requestorEmail, "requestorFirstName": self.requestorFirstName,
+            "resourceCount": len(self.resources)}
+        if self.changes is not None:
+            projection["Changes"]=self.changes
+        if self.pollStats is not None:
+            projection["pollStats"]=self.pollStats
+        return projection
+
+    # Whole payload, with every resource and the property group content, in the format of the former depInfoAndRes dictionary
+    def full_payload(self):
+        payload={"proGrpContent": self.config.content if self.config else {}, "name": self.name, "description": self.description,
+            "id": self.id, "status": self.status, "createdAt": self.createdAt, "leaseExpireAt": self.leaseExpireAt,
+            "createdBy": self.createdBy, "ownedBy": self.ownedBy, "lastUpdatedAt": self.lastUpdatedAt, "projectName": self.projectName,
+            "lastUpdatedBy": self.lastUpdatedBy, "Resources": {name: resource.details() for name, resource in self.resources.items()}}
+        if self.changes is not None:
+            payload["Changes"]=self.changes
+        if self.pollStats is not None:
+            payload["pollStats"]=self.pollStats
+        payload.update({"requestDetails": self.requestDetails, "requestStatus": self.requestStatus,
+            "requestorEmail": self.requestorEmail, "requestorFirstName": self.requestorFirstName})
+        return payload
+
+projectCache=TTLCache("projects", propertyGroupCacheTtl, propertyGroupCacheSize) # "vraHost:projectId" -> property group name
+propertyGroupCache=TTLCache("propertyGroups", propertyGroupCacheTtl, propertyGroupCacheSize,
+    encode=lambda config: config.content, decode=NotificationConfig.from_content) # "vraHost:property group name" -> NotificationConfig
+
+# Gets the name of the property group of a project, from the cache when possible.
+def get_property_group_name(vraApi, projectId):
+    propGrp=projectCache.get(vraApi.host+":"+projectId)
+    if propGrp is None:
+        print('Querying API to get property group name...')
+        propGrp=vraApi.get('/project-service/api/projects/'+projectId).json()['properties']['propertyGroup']
+        projectCache.set(vraApi.host+":"+projectId, propGrp)
+    return propGrp
+
+# Gets the settings of a property group, from the cache when possible.
+def get_property_group(vraApi, propGrp):
+    config=propertyGroupCache.get(vraApi.host+":"+propGrp) # the same name can exist on several vRA instances
+    if config is None:
+        print('Getting inputs from property group...')
+        proGrpInp=vraApi.get('/properties/api/property-groups/', {'name':propGrp}).json()
+        config=NotificationConfig.from_content(proGrpInp["content"][0]['properties'])
+        propertyGroupCache.set(vraApi.host+":"+propGrp, config)
+    return config
+
+userCache=TTLCache("users", userCacheTtl, userCacheSize) # "orgId:userId" -> {"email", "firstName"} or {"unknown": True}
+
+# Resolves the email and first name of several users of an organization in one go. Cached users are answered
+# from the cache and the missing ones are queried concurrently, so the whole batch costs at most one round trip.
+# Returns a dictionary userId -> {"email", "firstName"}, or None for users unknown to the organization.
+def resolve_users(vraApi, orgId, userIds):
+    resolved={}
+    missing=[]
+    for userId in dict.fromkeys(userIds): # removes duplicates, keeps the order
+        cached=userCache.get(orgId+":"+userId)
+        if cached is None:
+            missing.append(userId)
+        else:
+            resolved[userId]=None if "unknown" in cached else cached
+    def fetch(userId):
+        response=vraApi.get('/csp/gateway/am/api/users/' + userId + '/orgs/' + orgId + '/info')
+        if response.status_code in (400, 404):
+            print("User "+userId+" is unknown in organization "+orgId)
+            userCache.set(orgId+":"+userId, {"unknown":True}, ttl=userCacheNegativeTtl)
+            return None
+        user=response.json()['user'] # parsed once for both email and first name
+        identity={"email":user['email'], "firstName":user['firstName']}
+        userCache.set(orgId+":"+userId, identity)
+        return identity
+    if missing:
+        print("Discovering Email of users: "+", ".join(missing))
+        with ThreadPoolExecutor(max_workers=max(1, min(len(missing), vraPoolSize))) as executor:
+            for userId, identity in zip(missing, executor.map(in_context(fetch), missing)):
+                resolved[userId]=identity
+    return resolved
+
+priceCache=TTLCache("prices", priceCacheTtl, priceCacheSize) # canonical request hash -> daily price estimate text
+
+# Gets the daily price estimate of a catalog request, from the cache when the same catalog item, version, project
+# and inputs were already estimated. Otherwise asks vRA for the upfront prices and polls until they are calculated.
+def estimate_daily_price(vraApi, inputs, deploymentName):
+    bulkRequestCount="1" # for expenses simulation
+    reqInputs=inputs['requestInputs']
+    canonicalRequest=json.dumps({
+        "catalogItemId": inputs['catalogItemId'],
+        "version": inputs['catalogItemVersion'],
+        "projectId": inputs['projectId'],
+        "inputs": {str(key): value.strip() if isinstance(value, str) else value for key, value in reqInputs.items()}
+    }, sort_keys=True, separators=(",",":"), default=str)
+    priceKey=hashlib.sha256(canonicalRequest.encode()).hexdigest()
+    dailyPriceEstimate=priceCache.get(priceKey)
+    if dailyPriceEstimate is not None:
+        print("Daily price estimate found in the cache")
+        return {"dailyPriceEstimate":dailyPriceEstimate, "cached":True}
+    body= {
+    "bulkRequestCount": bulkRequestCount,
+    "deploymentName": deploymentName+" - Daily Price Estimate",
+    "inputs": reqInputs,
+    "projectId": inputs['projectId'],
+    "version": inputs['catalogItemVersion']
+    }
+    try:
+        requestUpfrontCost=vraApi.post('/catalog/api/items/'+inputs['catalogItemId']+'/upfront-prices/', body)
+        upfrontPriceId=requestUpfrontCost.json()['upfrontPriceId']
+        upFrontInfo, pollStats=poll_until(
+            lambda: vraApi.get('/catalog/api/items/'+inputs['catalogItemId']+'/upfront-prices/'+upfrontPriceId).json(),
+            lambda price: price["status"] in ("SUCCESS","FAILED"),
+            timeout=poll_timeout(inputs), name="price")
+    except VraUnavailableError as e:
+        # the estimate is optional, the notification is sent without it
+        print("Daily price estimate is not available: "+str(e))
+        return {"dailyPriceEstimate":"Not available", "cached":False}
+    print("Upfront price polled {0} times in {1} seconds".format(pollStats["polls"], pollStats["seconds"]))
+    if upFrontInfo["status"]=="SUCCESS":
+        integ,decim=str(upFrontInfo["dailyTotalPrice"]).split(".")
+        dailyPriceEstimate="AED "+integ+"."+decim[0:2]
+        priceCache.set(priceKey, dailyPriceEstimate)
+    else:
+        dailyPriceEstimate="Not available"
+    return {"dailyPriceEstimate":dailyPriceEstimate, "cached":False, "pollStats":pollStats}
+
+# Starts the daily price estimate in the background, so it runs while the rest of the data is collected.
+# Returns a future with the result of estimate_daily_price.
+def start_price_estimate(vraApi, inputs, deploymentName):
+    executor=ThreadPoolExecutor(max_workers=1)
+    priceEstimate=executor.submit(in_context(estimate_daily_price), vraApi, inputs, deploymentName)
+    executor.shutdown(wait=False) # the thread ends with the estimate
+    return priceEstimate
+
+# Runs a small dependency graph of tasks on threads. tasks maps a name to (function, [dependency names]) and must
+# list every dependency before the tasks using it; each function receives the results of its dependencies in order.
+# Independent tasks overlap, the results (or the first error, in task order) are returned once all of them finished.
+def run_task_graph(tasks):
+    futures={}
+    def run(name):
+        function, dependencies=tasks[name]
+        return function(*[futures[dependency].result() for dependency in dependencies])
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        for name, (function, dependencies) in tasks.items():
+            for dependency in dependencies:
+                if dependency not in futures:
+                    raise ValueError("Task "+name+" depends on "+dependency+" which is not declared before it")
+            futures[name]=executor.submit(in_context(run), name)
+    return {name: future.result() for name, future in futures.items()}
+
 # Gets inputs from the VRa API and the deployment context and build a Dictionary
 def create_dictionary(inputs):
     # VARIABLES
     global apiVersion
     orgId=inputs["orgId"] # gets organization ID from the inputs
-    depInfoAndRes={}# Declaring the main dictionary
-    bearer=inputs['bearerToken']  #Before querying the API, a bearer token needs to be obtained.
+    depInfoAndRes=Deployment() # Declaring the main model
     projectId=inputs["projectId"] # reads the project ID from the inputs
     deploymentId=inputs['deploymentId'] # deployment ID from the inputs
     userName=inputs["userName"] # username from the context inputs
-    vraUrl=inputs["vra_fqdn"] # vRA url
     eventType=inputs["eventType"] if "eventType" in inputs else "EXPIRE_NOTIFICATION" # evenType from the context inputs
     eventTopicId=inputs["__metadata"]["eventTopicId"] # event topic ID from the context inputs
-
-    
-    # defining a common header for all the subsequent API queries.
-    headers={"Accept":"application/json","Content-Type":"application/json", "Authorization":bearer}
+    vraApi=vra_client(inputs) # pooled client shared by all the subsequent API queries.
     
+    userId=inputs['userId'].split(":")[1] # requestor's user ID from the context inputs
+    # resources per page, an input so the first page is queried without waiting for the property group
+    resourcePageSize=int(inputs["resource_page_size"]) if "resource_page_size" in inputs and inputs["resource_page_size"] else defaultResourcePageSize
+
     # test vRA API Connection
-    print("Testing vRA API Connection...")
-    apiAbout=requests.get('https://' + vraUrl + '/project-service/api/about?apiVersion='+apiVersion, data='', headers=headers, verify=False)
-    if apiAbout.status_code==200:
-        print("Connection to vRA tested succesfully...")
-    else:
-        print('[?] Unexpected Error: [HTTP {0}]: Content: {1}'.format(apiAbout.status_code, apiAbout.content))
-        sys.exit("Error: Connection to vRA API was not made succesfully")
+    def check_connection():
+        if vraApi.guard.healthy(vraApi.settings.rateLimitDir):
+            print("vRA API answered recently, skipping the connection test...")
+            return None
+        apiAbout=vraApi.get('/project-service/api/about')
+        if apiAbout.status_code==200:
+            print("Connection to vRA tested succesfully...")
+        else:
+            print('[?] Unexpected Error: [HTTP {0}]: Content: {1}'.format(apiAbout.status_code, apiAbout.content))
+            sys.exit("Error: Connection to vRA API was not made succesfully")
+        return apiAbout
 
-    # Getting inputs from property group by querying the API
-    print('Querying API to get property group name...')
-    projectInfoJson=requests.get('https://' + vraUrl + '/project-service/api/projects/'+projectId+'?apiVersion='+apiVersion , data='', headers=headers, verify=False)
-    propGrp=projectInfoJson.json()['properties']['propertyGroup']
-    print('Getting inputs from property group...')
-    propGrpInpJson=requests.get('https://' + vraUrl + '/properties/api/property-groups/?apiVersion='+apiVersion+'&name=' + propGrp , data='', headers=headers, verify=False)
-    proGrpInp=propGrpInpJson.json()
+    # Querying the API. The independent queries run concurrently, only the property group waits for the project lookup.
+    print("Testing vRA API Connection...")
+    print('Querying API to get deployment info and resources, request details and requestor...')
+    apiResults=run_task_graph({
+        "about": (check_connection, []),
+        "project": (lambda: get_property_group_name(vraApi, projectId), []),
+        "propertyGroup": (lambda propGrp: get_property_group(vraApi, propGrp), ["project"]),
+        "deployment": (lambda: vraApi.get('/deployment/api/deployments/' + deploymentId, {'deleted':'true','expand':'project'}).json(), []),
+        "resourcePage": (lambda: get_resource_page(vraApi, deploymentId, 0, resourcePageSize), []),
+        "request": (lambda: vraApi.get('/deployment/api/requests/'+inputs["id"]).json(), []),
+        "user": (lambda: resolve_users(vraApi, orgId, [userId])[userId], []),
+        # only starts the price estimate of catalog requests, it is collected by generate_html
+        "priceEstimate": (lambda deployment: start_price_estimate(vraApi, inputs, deployment['name'] if 'name' in deployment else " ")
+            if eventType=="CREATE_DEPLOYMENT" and eventTopicId=="deployment.request.pre" and inputs.get('requestType')=="CATALOG" else None, ["deployment"])
+    })
+    if apiResults["priceEstimate"] is not None:
+        depInfoAndRes.priceEstimate=apiResults["priceEstimate"] # future of the daily price estimate
+    config=apiResults["propertyGroup"]
 
-    # Adding all property group variables to the dictionary
-    depInfoAndRes['proGrpContent']=proGrpInp["content"][0]['properties']
+    # Adding the property group settings, its raw content stays in config.content
+    depInfoAndRes.config=config # parsed settings for generate_html and send_email
 
     # Time Zone settings #
-    localTZ=pytz.timezone(depInfoAndRes['proGrpContent']['timeZone']['const'])
+    localTZ=get_timezone(config.timeZone)
 
-    # Discovering Deployment info and resources by querying the API
-    print('Discovering deployment info and resources...')
-    deploymentInfoJson=requests.get('https://' + vraUrl + '/deployment/api/deployments/' + deploymentId + '?apiVersion='+apiVersion+'&deleted=true&expand=project&expand=resources', data='', headers=headers, verify=False)
-    depInfo=deploymentInfoJson.json()
+    # Deployment info and resources
+    depInfo=apiResults["deployment"]
     # Date and Time Formating and Time Zone Convertion
-    createdAtConverted=depInfo['createdAt'].replace("T"," ").replace("Z","").split(".")
-    createdAtConverted=datetime.strptime(createdAtConverted[0],"%Y-%m-%d %H:%M:%S").astimezone(localTZ).strftime("%Y-%m-%d %H:%M:%S")
-    lastUpdatedConverted=depInfo['lastUpdatedAt'].replace("T"," ").replace("Z","").split(".")
-    lastUpdatedConverted=datetime.strptime(lastUpdatedConverted[0],"%Y-%m-%d %H:%M:%S").astimezone(localTZ).strftime("%Y-%m-%d %H:%M:%S")
-    if "leaseExpireAt" in depInfo:
-        leaseExpireConverted=depInfo['leaseExpireAt'].replace("T"," ").replace("Z","").split(".")
-        leaseExpireConverted=datetime.strptime(leaseExpireConverted[0],"%Y-%m-%d %H:%M:%S").astimezone(localTZ).strftime("%Y-%m-%d %H:%M:%S")
-    else:
-        leaseExpireConverted=""
+    createdAtConverted, lastUpdatedConverted, leaseExpireConverted=format_timestamps(
+        [depInfo['createdAt'], depInfo['lastUpdatedAt'], depInfo['leaseExpireAt'] if "leaseExpireAt" in depInfo else ""], localTZ)
     
     # Populate main dictionary with more data
-    depInfoAndRes["name"]=depInfo['name'] if "name" in depInfo else " "
-    depInfoAndRes["description"]=depInfo['description'] if "description" in depInfo else " "
-    depInfoAndRes["id"]=depInfo['id'] if "id" in depInfo else " "
-    depInfoAndRes["status"]=depInfo['status'] if "status" in depInfo else " "
-    depInfoAndRes["createdAt"]=createdAtConverted
-    depInfoAndRes["leaseExpireAt"]=leaseExpireConverted
-    depInfoAndRes["createdBy"]=depInfo['createdBy'] if "createdBy" in depInfo else " "
-    depInfoAndRes["ownedBy"]=depInfo['ownedBy'] if "ownedBy" in depInfo else " "
-    depInfoAndRes["lastUpdatedAt"]=lastUpdatedConverted
-    depInfoAndRes["projectName"]=depInfo['project']['name'] if "name" in depInfo['project'] else " "
-    depInfoAndRes["lastUpdatedBy"]=depInfo['lastUpdatedBy'] if "lastUpdatedBy" in depInfo else " "
-
-    #Loop through all resources in the deployment and create a nested dictionary with the resources details.
-    i=0
+    depInfoAndRes.name=depInfo['name'] if "name" in depInfo else " "
+    depInfoAndRes.description=depInfo['description'] if "description" in depInfo else " "
+    depInfoAndRes.id=depInfo['id'] if "id" in depInfo else " "
+    depInfoAndRes.status=depInfo['status'] if "status" in depInfo else " "
+    depInfoAndRes.createdAt=createdAtConverted
+    depInfoAndRes.leaseExpireAt=leaseExpireConverted
+    depInfoAndRes.createdBy=depInfo['createdBy'] if "createdBy" in depInfo else " "
+    depInfoAndRes.ownedBy=depInfo['ownedBy'] if "ownedBy" in depInfo else " "
+    depInfoAndRes.lastUpdatedAt=lastUpdatedConverted
+    depInfoAndRes.projectName=depInfo['project']['name'] if "name" in depInfo['project'] else " "
+    depInfoAndRes.lastUpdatedBy=depInfo['lastUpdatedBy'] if "lastUpdatedBy" in depInfo else " "
+
+    # Snapshot mode: resources not updated since the last notification of the deployment are taken from its snapshot.
+    snapshotDir=inputs["snapshot_dir"] if "snapshot_dir" in inputs and inputs["snapshot_dir"] else None
+    snapshot=load_snapshot(snapshotDir, deploymentId) if snapshotDir and eventType=="UPDATE_DEPLOYMENT" and eventTopicId=="deployment.request.post" else None
+    newSnapshot={} # resource ID -> name, lastUpdatedAt and Resource
+
+    #Loop through all resources in the deployment, one page at a time, and create a dictionary with the resources.
     resDetails={}
-    depResources=depInfo["resources"]
-    while i < len(depResources):
-        # Date and Time Formating and Time Zone Convertion
-        createdAtConverted=depResources[i]["createdAt"].replace("T"," ").replace("Z","").split(".") # date from the API, unrecognized characters are removed.
-        createdAtConverted=datetime.strptime(createdAtConverted[0],"%Y-%m-%d %H:%M:%S").astimezone(localTZ).strftime("%Y-%m-%d %H:%M:%S") # date from the API is converted to time object and to local time zone
-        resourceName=depResources[i]["name"] if depResources[i]["type"]=="Cloud.NSX.Network" else depResources[i]["properties"]["resourceName"]
-        resDetails[resourceName]={
-        "Name": resourceName,
-        "Type": depResources[i]["type"],
-        "State": depResources[i]["state"],
-        "started At": createdAtConverted
-        }
-        #if resouce type is Cloud.vSphere.Machine, query the API for additional resource details.
-        if depResources[i]["type"]=="Cloud.vSphere.Machine":
+    maxWorkers=config.apiMaxWorkers # concurrent resource queries
+    resourcesStarted=current_metrics().clock()
+    for depResources in iter_resource_pages(vraApi, deploymentId, resourcePageSize, apiResults["resourcePage"]):
+        i=0
+        vmResources=[] # (resourceName, resourceId) of every vSphere machine of the page, in deployment order
+        resCreatedAtConverted=format_timestamps([resource["createdAt"] for resource in depResources], localTZ) # all the resource dates of the page in one pass
+        while i < len(depResources):
+            createdAtConverted=resCreatedAtConverted[i]
+            resourceName=depResources[i]["name"] if depResources[i]["type"]=="Cloud.NSX.Network" else depResources[i]["properties"]["resourceName"]
+            resource=Resource(resourceName, depResources[i]["type"], depResources[i]["state"], createdAtConverted)
             resourceId=depResources[i]["id"]
-            VMDetailsJson=requests.get('https://' + vraUrl + '/deployment/api/resources/' + resourceId + '?apiVersion='+apiVersion+'', data='', headers=headers, verify=False)
-            VMDetails=VMDetailsJson.json()
-            VMDetailsProperties=VMDetails["properties"]
-            resDetails[resourceName]["IP Address"]=VMDetailsProperties["address"] if "address" in VMDetailsProperties else ""
-            resDetails[resourceName]["CPU count"]= VMDetailsProperties["cpuCount"] if "cpuCount" in VMDetailsProperties else ""
-            resDetails[resourceName]["Total Memory MB"]= VMDetailsProperties["totalMemoryMB"] if "totalMemoryMB" in VMDetailsProperties else ""
-            resDetails[resourceName]["Operating System"]= VMDetailsProperties["softwareName"] if "softwareName" in VMDetailsProperties else ""
-            #Loop through all disks and add them to the dictionary.
+            previous=snapshot[resourceId] if snapshot and resourceId in snapshot else None
+            if previous and previous["lastUpdatedAt"]==depResources[i]["lastUpdatedAt"] and previous["name"]==resourceName:
+                resource=Resource.from_details(previous["details"]) # unchanged since the snapshot
+            #if resouce type is Cloud.vSphere.Machine, the API is queried below for additional resource details.
+            elif depResources[i]["type"]=="Cloud.vSphere.Machine":
+                vmResources.append((resourceName, resourceId))
+            resDetails[resourceName]=resource
+            newSnapshot[resourceId]={"name":resourceName, "lastUpdatedAt":depResources[i]["lastUpdatedAt"], "resource":resource}
+            i+=1
+
+        # Query the additional details of the vSphere machines of the page concurrently, results come back in resource order.
+        vmDetailsList=get_vm_details(vraApi, [resourceId for resourceName, resourceId in vmResources], maxWorkers)
+        for (resourceName, resourceId), VMDetailsProperties in zip(vmResources, vmDetailsList):
+            resource=resDetails[resourceName]
+            resource.ipAddress=VMDetailsProperties["address"] if "address" in VMDetailsProperties else ""
+            resource.cpuCount=VMDetailsProperties["cpuCount"] if "cpuCount" in VMDetailsProperties else ""
+            resource.totalMemoryMB=VMDetailsProperties["totalMemoryMB"] if "totalMemoryMB" in VMDetailsProperties else ""
+            resource.operatingSystem=VMDetailsProperties["softwareName"] if "softwareName" in VMDetailsProperties else ""
+            #Add all the disks of the machine.
             if "disks" in VMDetailsProperties["storage"]:
-                j=0
-                while j < len(VMDetailsProperties["storage"]["disks"]):
-                    resDetails[resourceName]["disk "+str(j)]={
-                    "Name":VMDetailsProperties["storage"]["disks"][j]["name"],
-                    "Type":VMDetailsProperties["storage"]["disks"][j]["type"],
-                    "Capacity GB":VMDetailsProperties["storage"]["disks"][j]["capacityGb"]
-                    }
-                    j+=1
-        i+=1
+                resource.disks=tuple(Disk(disk["name"], disk["type"], disk["capacityGb"]) for disk in VMDetailsProperties["storage"]["disks"])
         
-    #adds an aditional entry to the dictionary with the resource details.
-    depInfoAndRes["Resources"]=resDetails
+    #adds the resources to the deployment.
+    depInfoAndRes.resources=resDetails
+    current_metrics().add_stage("resources", resourcesStarted)
+
+    # Snapshot mode: what changed since the last notification, and the snapshot for the next one
+    if snapshot is not None:
+        depInfoAndRes.changes={
+            "added": [resource["name"] for resourceId, resource in newSnapshot.items() if resourceId not in snapshot],
+            "changed": [resource["name"] for resourceId, resource in newSnapshot.items() if resourceId in snapshot and resource["lastUpdatedAt"]!=snapshot[resourceId]["lastUpdatedAt"]],
+            "removed": [resource["name"] for resourceId, resource in snapshot.items() if resourceId not in newSnapshot]
+        }
+        print("Changes since the last snapshot: "+json.dumps(depInfoAndRes.changes))
+    if snapshotDir and eventTopicId=="deployment.request.post":
+        if eventType=="DESTROY_DEPLOYMENT":
+            delete_snapshot(snapshotDir, deploymentId)
+        elif eventType in ("CREATE_DEPLOYMENT","UPDATE_DEPLOYMENT"):
+            save_snapshot(snapshotDir, deploymentId, {resourceId: {"name":resource["name"], "lastUpdatedAt":resource["lastUpdatedAt"],
+                "details":resource["resource"].details()} for resourceId, resource in newSnapshot.items()})
     
     # Getting details about the request and adding them to the dictionary.
-    requestInfo=requests.get('https://' + vraUrl + '/deployment/api/requests/'+inputs["id"]+'?apiVersion='+apiVersion, data='', headers=headers, verify=False)
-    requestInfoJson=requestInfo.json()
+    requestInfoJson=apiResults["request"]
     
     # Checking if approval is required.
     if eventType=="CREATE_DEPLOYMENT" and eventTopicId=="deployment.request.pre":
         print("Checking if approval is required...")
-        while int(requestInfoJson["completedTasks"]) < 4:
-            if requestInfoJson["status"]=="APPROVAL_PENDING":
-                depInfoAndRes['status']="APPROVAL_PENDING"
-                print("Approval is required...")
-                break
-            requestInfo=requests.get('https://' + vraUrl + '/deployment/api/requests/'+inputs["id"]+'?apiVersion='+apiVersion, data='', headers=headers, verify=False)
-            requestInfoJson=requestInfo.json()   
+        requestInfoJson, pollStats=poll_until(
+            lambda: vraApi.get('/deployment/api/requests/'+inputs["id"]).json(),
+            lambda request: int(request["completedTasks"]) >= 4 or request["status"] in requestFinalStatus,
+            first=requestInfoJson, timeout=poll_timeout(inputs), name="approval")
+        depInfoAndRes.pollStats={"approval":pollStats}
+        print("Request status polled {0} times in {1} seconds".format(pollStats["polls"], pollStats["seconds"]))
+        if requestInfoJson["status"]=="APPROVAL_PENDING":
+            depInfoAndRes.status="APPROVAL_PENDING"
+            print("Approval is required...")
             
-    depInfoAndRes['requestDetails']=requestInfoJson["details"] if (requestInfoJson["details"]!="")  else "No additional details."
-    depInfoAndRes['requestStatus']=requestInfoJson["status"] if "status" in requestInfoJson else "No Status"
+    depInfoAndRes.requestDetails=requestInfoJson["details"] if (requestInfoJson["details"]!="")  else "No additional details."
+    depInfoAndRes.requestStatus=requestInfoJson["status"] if "status" in requestInfoJson else "No Status"
     
     
     # setting variables in case the lease has expired.
     if userName=="system-user" and inputs['actionName']=="Expire":
-        userName=depInfoAndRes['createdBy']
-        depInfoAndRes['status']="LEASE_EXPIRED"
+        userName=depInfoAndRes.createdBy
+        depInfoAndRes.status="LEASE_EXPIRED"
 
-    # Discovering Requestor's Email and First Name by querying the API
-    print("Discovering Requestor's Email...")
-    userId=inputs['userId'].split(":")[1]
-    response_Email=requests.get('https://' + vraUrl + '/csp/gateway/am/api/users/' + userId + '/orgs/' + orgId + '/info?apiVersion='+apiVersion, data='', headers=headers, verify=False)
-    depInfoAndRes['requestorEmail']=response_Email.json()['user']['email'] # gets the email from the user who launched the deployment.
-    depInfoAndRes['requestorFirstName']=response_Email.json()['user']['firstName'] # gets the first name from the user who launched the deployment.
+    # Requestor's Email and First Name
+    userInfo=apiResults["user"]
+    if userInfo is None:
+        sys.exit("Error: Requestor "+userId+" was not found in organization "+orgId)
+    depInfoAndRes.requestorEmail=userInfo['email'] # gets the email from the user who launched the deployment.
+    depInfoAndRes.requestorFirstName=userInfo['firstName'] # gets the first name from the user who launched the deployment.
     
     return depInfoAndRes
     
-# Format HTML body of the email.
-def generate_html(inputs,depInfoAndRes):
-    #VARIABLES
-    global apiVersion
-    localTZ=pytz.timezone(depInfoAndRes['proGrpContent']['timeZone']['const']) # Time Zone settings
-    bearer=inputs['bearerToken']  #Before querying the API, a bearer token needs to be obtained.
-    bulkRequestCount="1" # for expenses simulation
-    deploymentId=inputs['deploymentId'] # deployment ID from the inputs
-    vraUrl=inputs["vra_fqdn"] # vRA url
-    eventType=inputs["eventType"] if "eventType" in inputs else "EXPIRE_NOTIFICATION" # evenType from the context inputs
-    eventTopicId=inputs["__metadata"]["eventTopicId"] # event topic ID from the context inputs
-    headers={"Accept":"application/json","Content-Type":"application/json", "Authorization":bearer} # defining a common header for all the subsequent API queries.
-    logoWidth =depInfoAndRes['proGrpContent']['logo_company_width_pixels']['const'] if 'logo_company_width_pixels' in depInfoAndRes['proGrpContent'] else " "  # defines the width size of the logo in pixels.
-    logoHeight=depInfoAndRes['proGrpContent']['logo_company_height_pixels']['const'] if 'logo_company_height_pixels' in depInfoAndRes['proGrpContent'] else " "   # defines the heights size of the logo in pixelso.
-    logoCompany=depInfoAndRes['proGrpContent']['logo']['const'] if 'logo' in depInfoAndRes['proGrpContent'] else " "   # gets the string corresponding to the base64 encoded JPG logo.
-    userNameFirstName=depInfoAndRes['requestorFirstName'] # Requestors First Name
-    dateAndTime=datetime.now().astimezone(localTZ).strftime("%Y-%m-%d %H:%M:%S") # gets current date and time, applies a format and convert to local time zone
-    build_direction="LEFT_TO_RIGHT" # Neccesary for the convert dictionary to HTML function
+# Minifies an HTML template source: whitespace between tags is dropped and the CSS of the style block is compacted.
+def minify_html(source):
+    def minify_css(match):
+        return re.sub(r"\s*([{};:,])\s*", r"\1", match.group(0))
+    source=re.sub(r"<style>.*?</style>", minify_css, source, flags=re.S)
+    source=re.sub(r">\s+<", "><", source)
+    return re.sub(r"\s+", " ", source).strip()
+
+# HTML template compiled once: the minified source is split into literal parts and {field} names, so rendering
+# only joins the field values in between the literals.
+class HtmlTemplate:
+    fieldPattern=re.compile(r"\{(\w+)\}")
+
+    def __init__(self, source):
+        parts=self.fieldPattern.split(minify_html(source))
+        self.literals=parts[0::2]
+        self.fields=parts[1::2]
+
+    # yields the body in chunks, field values that are generators (like the resource table) are streamed through
+    def render_iter(self, values):
+        yield self.literals[0]
+        for fieldName, literal in zip(self.fields, self.literals[1:]):
+            value=values[fieldName]
+            if isinstance(value, str):
+                yield value
+            elif hasattr(value, "__next__"):
+                yield from value
+            else:
+                yield str(value)
+            yield literal
+
+    def render(self, values):
+        return "".join(self.render_iter(values))
+
+# Streams a dictionary as the LEFT_TO_RIGHT table built by json2table's convert: one row per key with the key in
+# the header cell, nested dictionaries (like the disks) become nested tables.
+def iter_html_table(data):
+    yield "<table>"
+    for key, value in data.items():
+        yield "<tr><th>"+str(key)+"</th><td>"
+        if isinstance(value, dict):
+            yield from iter_html_table(value)
+        else:
+            yield str(value)
+        yield "</td></tr>"
+    yield "</table>"
+
+# Streams the resource details table one resource row at a time, listing at most maxRows resources
+# followed by a summary row with the number of resources left out. resDetails maps names to Resources or row dictionaries.
+def iter_resource_table(resDetails, maxRows):
+    yield "<table>"
+    for count, (resourceName, details) in enumerate(resDetails.items()):
+        if count >= maxRows:
+            yield '<tr><th colspan="2">... and '+str(len(resDetails)-maxRows)+' more resources</th></tr>'
+            break
+        yield "<tr><th>"+str(resourceName)+"</th><td>"
+        yield from iter_html_table(details.details() if isinstance(details, Resource) else details)
+        yield "</td></tr>"
+    yield "</table>"
 
-    # applies the same style to all tables, rows and cells on the HTML body in all Event Types
-    htmlStyle = f'''                                                                                    
-              <style>
-          table {{
-                width: 100%;
-                border: 1px solid black;
-                border-radius: 20px;
-                }}
-
-          td {{
-                text-align: left;
-                padding: 8px;
-                border: 1px solid black;
-                background-color: #F7F9F9;
-                border-radius: 10px;
-                 }}
-                 
-          th     {{
-                text-align: left;
-                padding: 8px;
-                border: 1px solid black;
-                background-color: #EBF5FB;
-                border-radius: 10px;
-                 }}
-          tr {{
-              background-color: #FDFEFE;
-              }}
-        .container {{
-        width: {logoWidth}px;
-        height: {logoHeight}px;
-                }}
-        img {{
-        width: 100%;
-        height: 100%;
-        object-fit: cover;
-            }}
-    </style style="width:100%">
+# applies the same style to all tables, rows and cells on the HTML body in all Event Types
+htmlStyle='''
+    <style>
+        table { width: 100%; border: 1px solid black; border-radius: 20px; }
+        td { text-align: left; padding: 8px; border: 1px solid black; background-color: #F7F9F9; border-radius: 10px; }
+        th { text-align: left; padding: 8px; border: 1px solid black; background-color: #EBF5FB; border-radius: 10px; }
+        tr { background-color: #FDFEFE; }
+        .container { width: {logoWidth}px; height: {logoHeight}px; }
+        img { width: 100%; height: 100%; object-fit: cover; }
+    </style>
     '''
-    
-    # uses the global variable logoCompany for adding the logo to the HTML body
-    logo=f'''\
-    <div class="container">
-      <img src="data:image/png;base64, {logoCompany}" alt="Image" />
-    </div>
-    
+
+# start of every email: style, logo, date and greeting
+htmlHeader='''
+    <html>
+        <body>
+        '''+htmlStyle+'''
+            <div class="container">
+                <img src="cid:{logoCid}" alt="Image" />
+            </div>
+            <br>
+            <p><strong>Date and Time:</strong> {dateAndTime}<br></p>
+            <p>Hello <strong> {firstName},</strong></p>
     '''
-    
-    mailFooter=f'''\
-    <table>
-     <tr>
-      <td>
-       <a href="https://{vraUrl}/automation-ui/#/deployment-ui;ash=%2Fworkload%2Fdeployment%2F{deploymentId}">Click here to see your request</a>
-      </td>
-     </tr>
-    </table>
+
+# Builds the source of a notification: greeting, intro sentence, deployment information list,
+# an optional table section (filled with the resources field) and the optional link to the deployment.
+# With sectionOnly the header is left out, for the sections of a digest.
+def html_template_source(intro, infoItems, sectionTitle=None, footer=True, sectionOnly=False):
+    source='''
+            <p>'''+intro+'''</p>
+            <table>
+                <tr>
+                    <td>
+                        <h2><strong>Deployment Information:</strong></h2>
+                        <ul>'''+"".join("<li> "+label+": <strong> "+value+" </strong></li>" for label, value in infoItems)+'''</ul>
+                    </td>
+                </tr>
+            </table>
     '''
-    
-    # write the HTML Template for each Event Type
-    if eventType=="CREATE_DEPLOYMENT" and eventTopicId=="deployment.request.pre": # The deployment has just started
-        if depInfoAndRes['status']=="APPROVAL_PENDING":
-            mailHeader=f'''\
-            <p>Your request for deployment <strong>{depInfoAndRes["name"]}</strong>
-            is pending for approval.</p>
+    if sectionTitle:
+        source+='''
             <table>
-            <tr>
-                <td>
-                <h2><strong>Deployment Information:</strong></h2>
-                <ul>
-                    <li> Deployment name: <strong> {depInfoAndRes["name"]} </strong></li>
-                    <li> Deployment Description: <strong> {depInfoAndRes["description"]} </strong></li>
-                    <li> Deployment started at: <strong>{depInfoAndRes["createdAt"]}</strong></li>
-                    <li> Deployment status: <strong> {depInfoAndRes['status']}</strong></li>
-                    <li> Deployment details: <strong> {depInfoAndRes['requestDetails']}</strong></li>
-                    </ul>
+                <tr>
+                    <td>
+                        <h2><strong>'''+sectionTitle+'''</strong></h2>
+                        {resources}
                     </td>
-                    </tr>
+                </tr>
             </table>
-            '''
-        else:
-            mailHeader=f'''\
-            <p>Your request for deployment <strong>{depInfoAndRes["name"]}</strong>
-            has been received and is in progress.</p>
+        '''
+    if footer:
+        source+='''
             <table>
                 <tr>
                     <td>
-                    <h2><strong>Deployment Information:</strong></h2>
-                    <ul>
-                    <li> Deployment name: <strong> {depInfoAndRes["name"]} </strong></li>
-                    <li> Deployment Description: <strong> {depInfoAndRes["description"]} </strong></li>
-                    <li> Deployment started at: <strong>{depInfoAndRes["createdAt"]}</strong></li>
-                    <li> Deployment status: <strong> {depInfoAndRes["status"]}</strong></li>
-                    <li> Deployment details: <strong> {depInfoAndRes['requestDetails']}</strong></li>
-                    </ul>
+                        <a href="https://{vraUrl}/automation-ui/#/deployment-ui;ash=%2Fworkload%2Fdeployment%2F{deploymentId}">Click here to see your request</a>
                     </td>
                 </tr>
             </table>
-            '''
+        '''
+    return source if sectionOnly else htmlHeader+source+"</body></html>"
+
+# Template sources for each Event Type, compiled on first use by get_template
+htmlTemplateSources={
+    "CREATE_APPROVAL_PENDING": lambda **options: html_template_source("Your request for deployment <strong>{name}</strong> is pending for approval.",
+        [("Deployment name","{name}"),("Deployment Description","{description}"),("Deployment started at","{createdAt}"),("Deployment status","{status}"),("Deployment details","{requestDetails}")],
+        "Requested Resources:", **options),
+    "CREATE_IN_PROGRESS": lambda **options: html_template_source("Your request for deployment <strong>{name}</strong> has been received and is in progress.",
+        [("Deployment name","{name}"),("Deployment Description","{description}"),("Deployment started at","{createdAt}"),("Deployment status","{status}"),("Deployment details","{requestDetails}")],
+        "Requested Resources:", **options),
+    "DEPLOYMENT_FAILED": lambda **options: html_template_source("Your request for deployment <strong>{name}</strong> has failed.",
+        [("Deployment name","{name}"),("Deployment Description","{description}"),("Deployment started at","{createdAt}"),("Deployment finished at","{dateAndTime}"),("Deployment status","{status}"),("Request details","{requestDetails}")], **options),
+    "DEPLOYMENT_COMPLETED": lambda **options: html_template_source("Your request for deployment <strong>{name}</strong> has been completed.",
+        [("Deployment name","{name}"),("Deployment Description","{description}"),("Deployment started at","{createdAt}"),("Deployment finished at","{dateAndTime}"),("Deployment lease expires","{leaseExpireAt}"),("Deployment status","{status}"),("Request details","{requestDetails}")],
+        "Resources Details:", **options),
+    "DEPLOYMENT_UPDATED": lambda **options: html_template_source("Your request for deployment <strong>{name}</strong> has been completed.",
+        [("Deployment name","{name}"),("Deployment Description","{description}"),("Deployment started at","{createdAt}"),("Deployment finished at","{dateAndTime}"),("Deployment lease expires","{leaseExpireAt}"),("Deployment status","{status}"),("Request details","{requestDetails}"),("Resources unchanged","{unchangedCount}")],
+        "Changed Resources:", **options),
+    "DESTROY": lambda **options: html_template_source("Your request to delete the deployment <strong>{name}</strong> has been completed.",
+        [("Deployment name","{name}"),("Deployment Description","{description}"),("Deployment created at","{createdAt}"),("Deployment deleted at","{dateAndTime}"),("Deployment status","{status}")],
+        footer=False, **options),
+    "EXPIRE": lambda **options: html_template_source("Your deployment <strong>{name}</strong> has expired.",
+        [("Deployment name","{name}"),("Deployment Description","{description}"),("Deployment created at","{createdAt}"),("Deployment lease expires","{leaseExpireAt}")],
+        footer=False, **options),
+    "UNAVAILABLE": lambda **options: html_template_source("There is a new notification about your deployment, but {platformName} could not be reached to read its details.",
+        [("Deployment ID","{deploymentId}"),("Event","{eventType}"),("Request ID","{requestId}"),("Reason","{reason}")], **options),
+    "DIGEST": lambda **options: htmlHeader+"<p>You have <strong>{eventCount}</strong> new notifications about your deployments.</p>{events}</body></html>"
+}
+htmlTemplates={} # compiled templates, kept for the warm invocations
+
+# Returns the compiled template of an Event Type (or only its section), compiling it on first use.
+def get_template(templateName, sectionOnly=False):
+    if (templateName, sectionOnly) not in htmlTemplates:
+        source=htmlTemplateSources[templateName](sectionOnly=True) if sectionOnly else htmlTemplateSources[templateName]()
+        htmlTemplates[(templateName, sectionOnly)]=HtmlTemplate(source)
+    return htmlTemplates[(templateName, sectionOnly)]
+
+logoParts=OrderedDict() # logo version -> prebuilt MIME image part
+
+# Returns the inline MIME image part of the property group logo, or None when there is no usable logo.
+# The logo is decoded once per version (the hash of its base64 string) and the part is reused by every message.
+def get_logo_part(config):
+    logo="".join(str(config.logo).split()) # base64 without whitespace
+    if not logo:
+        return None
+    logoVersion=hashlib.sha1(logo.encode()).hexdigest()
+    if logoVersion in logoParts:
+        logoParts.move_to_end(logoVersion)
+        return logoParts[logoVersion]
+    try:
+        logoBytes=base64.b64decode(logo)
+    except ValueError as e:
+        print("Ignoring logo that is not valid base64: "+str(e))
+        return None
+    subtype="png" if logoBytes.startswith(b"\x89PNG") else "jpeg" if logoBytes.startswith(b"\xff\xd8") else "gif" if logoBytes.startswith(b"GIF8") else None
+    if subtype is None:
+        print("Ignoring logo that is not a PNG, JPG or GIF image")
+        return None
+    from email.mime.image import MIMEImage # inline logo
+    logoPart=MIMEImage(logoBytes, subtype) # base64 encoded once here, the part is serialized as is afterwards
+    logoPart.add_header("Content-ID", "<logo-"+logoVersion[:16]+"@ultimate-notifications>")
+    logoPart.add_header("Content-Disposition", "inline", filename="logo."+("jpg" if subtype=="jpeg" else subtype))
+    logoParts[logoVersion]=logoPart
+    while len(logoParts) > logoPartsSize:
+        logoParts.popitem(last=False)
+    return logoPart
+
+# Format HTML body of the email.
+def generate_html(inputs,depInfoAndRes,sectionOnly=False):
+    #VARIABLES
+    global apiVersion
+    config=depInfoAndRes.config # settings from the property group
+    localTZ=get_timezone(config.timeZone) # Time Zone settings
+    deploymentId=inputs['deploymentId'] # deployment ID from the inputs
+    vraUrl=inputs["vra_fqdn"] # vRA url
+    eventType=inputs["eventType"] if "eventType" in inputs else "EXPIRE_NOTIFICATION" # evenType from the context inputs
+    eventTopicId=inputs["__metadata"]["eventTopicId"] # event topic ID from the context inputs
+    vraApi=vra_client(inputs) # pooled client shared by all the subsequent API queries.
+    logoWidth =config.logoWidth  # defines the width size of the logo in pixels.
+    logoHeight=config.logoHeight   # defines the heights size of the logo in pixelso.
+    logoPart=get_logo_part(config)   # inline MIME part of the base64 encoded JPG/PNG logo, referenced by its Content-ID.
+    userNameFirstName=depInfoAndRes.requestorFirstName # Requestors First Name
+    dateAndTime=datetime.now().astimezone(localTZ).strftime("%Y-%m-%d %H:%M:%S") # gets current date and time, applies a format and convert to local time zone
+    build_direction="LEFT_TO_RIGHT" # Neccesary for the convert dictionary to HTML function
+
+    # fields shared by the templates of all Event Types
+    values={
+        "logoWidth": logoWidth,
+        "logoHeight": logoHeight,
+        "logoCid": logoPart["Content-ID"].strip("<>") if logoPart else "",
+        "dateAndTime": dateAndTime,
+        "firstName": userNameFirstName,
+        "name": depInfoAndRes.name,
+        "description": depInfoAndRes.description,
+        "createdAt": depInfoAndRes.createdAt,
+        "leaseExpireAt": depInfoAndRes.leaseExpireAt,
+        "status": depInfoAndRes.status,
+        "requestDetails": depInfoAndRes.requestDetails,
+        "vraUrl": vraUrl,
+        "deploymentId": deploymentId,
+        "resources": "",
+        "unchangedCount": ""
+    }
+
+    # pick the HTML Template for each Event Type
+    if eventType=="CREATE_DEPLOYMENT" and eventTopicId=="deployment.request.pre": # The deployment has just started
+        templateName="CREATE_APPROVAL_PENDING" if depInfoAndRes.status=="APPROVAL_PENDING" else "CREATE_IN_PROGRESS"
         # Getting only basic data from the input
         reqInputs=inputs['requestInputs']
         reqInputsCleanedUp={
@@ -298,264 +1274,509 @@ def generate_html(inputs,depInfoAndRes):
             "Target Network": reqInputs['targetNetwork'] if 'targetNetwork' in reqInputs else "",
             "Operating System": reqInputs['operatingSystem'].split(",")[0]  if 'operatingSystem' in reqInputs else ""
         }
-        if 'custom_property_display' in depInfoAndRes['proGrpContent']:
-            x=0
-            while x < len(depInfoAndRes['proGrpContent']['custom_property_display']['const']):
-                reqInputsCleanedUp[depInfoAndRes['proGrpContent']['custom_property_display']['const'][x]]=reqInputs[depInfoAndRes['proGrpContent']['custom_property_display']['const'][x]] if depInfoAndRes['proGrpContent']['custom_property_display']['const'][x] in reqInputs else " "
-                x+=1
+        for customProperty in config.customPropertyDisplay:
+            reqInputsCleanedUp[customProperty]=reqInputs[customProperty] if customProperty in reqInputs else " "
         # If the deployment has started from CATALOG, calculate up front daily prices
         if inputs['requestType']=="CATALOG":
-            body= {
-            "bulkRequestCount": bulkRequestCount,
-            "deploymentName": depInfoAndRes["name"]+" - Daily Price Estimate",
-            "inputs": reqInputs,
-            "projectId": inputs['projectId'],
-            "version": inputs['catalogItemVersion']
-            }
-            requestUpfrontCost=requests.post('https://' + vraUrl + '/catalog/api/items/'+inputs['catalogItemId']+'/upfront-prices/?apiVersion='+apiVersion, headers=headers, data=json.dumps(body), verify=False)
-            statusUpfrontPrice=""
-            while statusUpfrontPrice != "SUCCESS":
-                upFrontInfo=requests.get('https://' + vraUrl + '/catalog/api/items/'+inputs['catalogItemId']+'/upfront-prices/'+requestUpfrontCost.json()['upfrontPriceId']+'?apiVersion='+apiVersion, data='', headers=headers, verify=False)
-                statusUpfrontPrice=upFrontInfo.json()["status"]
-            integ,decim=str(upFrontInfo.json()["dailyTotalPrice"]).split(".")
-            reqInputsCleanedUp["Daily Price Estimate"]= "AED "+integ+"."+decim[0:2]
-
-        html_resources=convert(reqInputsCleanedUp, build_direction=build_direction)  #converts inputs to HTML
-        #Building the HTML body.
-        html=f"""\
-        <html>
-          <body>
-          {htmlStyle}
-              {logo}
-              <br>
-              <p><strong>Date and Time:</strong> {dateAndTime}<br></p>
-              <p>Hello <strong> {depInfoAndRes['requestorFirstName']},</strong></p>
-              {mailHeader}
-            <table>
-             <tr>
-              <td>
-              <h2><strong>Requested Resources:</strong></h2>
-              {html_resources}
-              </tr>
-             </td>
-            </table>
-            {mailFooter}
-          </body>
-        </html>
-        """
+            priceEstimate=depInfoAndRes.priceEstimate # started in the background by create_dictionary
+            depInfoAndRes.priceEstimate=None
+            price=priceEstimate.result() if priceEstimate else estimate_daily_price(vraApi, inputs, depInfoAndRes.name)
+            if "pollStats" in price:
+                if depInfoAndRes.pollStats is None:
+                    depInfoAndRes.pollStats={}
+                depInfoAndRes.pollStats["upfrontPrice"]=price["pollStats"]
+            reqInputsCleanedUp["Daily Price Estimate"]=price["dailyPriceEstimate"]
+
+        from json2table import convert # diccionaries to html, only needed for the requested inputs
+        values["resources"]=convert(reqInputsCleanedUp, build_direction=build_direction)  #converts inputs to HTML
 
     elif (eventType=="CREATE_DEPLOYMENT" or eventType=="UPDATE_DEPLOYMENT") and eventTopicId=="deployment.request.post":    # The deployment has finished or has been updated
-        html_resources=convert(depInfoAndRes["Resources"], build_direction=build_direction)
-        # Building the HTML body.
         # checking if request Failed
-        if (depInfoAndRes["status"])=="CREATE_FAILED":
-            depInfoAndRes['status']==depInfoAndRes['requestStatus']
-            html=f"""\
-            <html>
-            <body>
-            {htmlStyle}
-              {logo}
-              <br>
-              <p><strong>Date and Time:</strong> {dateAndTime}<br></p>
-              <p>Hello <strong> {depInfoAndRes['requestorFirstName']},</strong></p>
-              <p>Your request for deployment <strong>{depInfoAndRes["name"]}</strong>
-              has failed.</p>
-              <table>
-                <tr>
-                    <td>
-                    <h2><strong>Deployment Information:</strong></h2>
-                    <ul>
-                    <li> Deployment name: <strong> {depInfoAndRes["name"]} </strong></li>
-                    <li> Deployment Description: <strong> {depInfoAndRes["description"]} </strong></li>
-                    <li> Deployment started at: <strong>{depInfoAndRes["createdAt"]}</strong></li>
-                    <li> Deployment finished at: <strong>{dateAndTime}</strong></li>
-                    <li> Deployment status: <strong> {depInfoAndRes["status"]}</strong></li>
-                    <li> Request details: <strong> {depInfoAndRes['requestDetails']}</strong></li>
-                    </ul>
-                    </td>
-                </tr>
-                </table>
-                <table>
-                <tr>
-                <td>
-                </tr>
-                </td>
-                </table>
-                {mailFooter}
-            </body>
-            </html>
-            """
-
+        if (depInfoAndRes.status)=="CREATE_FAILED":
+            templateName="DEPLOYMENT_FAILED"
+        elif depInfoAndRes.changes is not None:
+            # snapshot mode: only the resources added, changed or removed since the last notification are listed
+            templateName="DEPLOYMENT_UPDATED"
+            changes=depInfoAndRes.changes
+            changedResources={}
+            for change in ("added", "changed"):
+                for resourceName in changes[change]:
+                    changedResources[resourceName]=dict({"Change": change}, **depInfoAndRes.resources[resourceName].details())
+            for resourceName in changes["removed"]:
+                changedResources[resourceName+" (removed)"]={"Change": "removed", "Name": resourceName}
+            values["unchangedCount"]=len(depInfoAndRes.resources)-len(changes["added"])-len(changes["changed"])
+            values["resources"]=iter_resource_table(changedResources, config.resourceTableMaxRows)
         else:
-            html=f"""\
-            <html>
-            <body>
-            {htmlStyle}
-              {logo}
-              <br>
-              <p><strong>Date and Time:</strong> {dateAndTime}<br></p>
-              <p>Hello <strong> {depInfoAndRes['requestorFirstName']},</strong></p>
-              <p>Your request for deployment <strong>{depInfoAndRes["name"]}</strong>
-              has been completed.</p>
-              <table>
-                <tr>
-                    <td>
-                    <h2><strong>Deployment Information:</strong></h2>
-                    <ul>
-                    <li> Deployment name: <strong> {depInfoAndRes["name"]} </strong></li>
-                    <li> Deployment Description: <strong> {depInfoAndRes["description"]} </strong></li>
-                    <li> Deployment started at: <strong>{depInfoAndRes["createdAt"]}</strong></li>
-                    <li> Deployment finished at: <strong>{dateAndTime}</strong></li>
-                    <li> Deployment lease expires: <strong>{depInfoAndRes["leaseExpireAt"]}</strong></li>
-                    <li> Deployment status: <strong> {depInfoAndRes["status"]}</strong></li>
-                    <li> Request details: <strong> {depInfoAndRes['requestDetails']}</strong></li>
-                    </ul>
-                    </td>
-                </tr>
-                </table>
-                <table>
-                <tr>
-                <td>
-                <h2><strong>Resources Details:</strong></h2>
-                {html_resources}
-                </tr>
-                </td>
-                </table>
-                {mailFooter}
-            </body>
-            </html>
-            """
+            templateName="DEPLOYMENT_COMPLETED"
+            values["resources"]=iter_resource_table(depInfoAndRes.resources, config.resourceTableMaxRows) # rendered while the body is built
 
-
-        
     elif eventType=="DESTROY_DEPLOYMENT" and eventTopicId=="deployment.request.post": #The deployment has been deleted.
-        # Building the HTML body.
-        html=f"""\
-        <html>
-          <body>
-          {htmlStyle}
-              {logo}
-              <br>
-              <p><strong>Date and Time:</strong> {dateAndTime}<br></p>
-              <p>Hello <strong> {depInfoAndRes['requestorFirstName']},</strong></p>
-              <p>Your request to delete the deployment <strong>{depInfoAndRes["name"]}</strong>
-              has been completed.</p>
-            <table>
-             <tr>
-              <td>
-              <h2><strong>Deployment Information:</strong></h2>
-              <ul>
-              <li> Deployment name: <strong> {depInfoAndRes["name"]} </strong></li>
-              <li> Deployment Description: <strong> {depInfoAndRes["description"]} </strong></li>
-              <li> Deployment created at: <strong>{depInfoAndRes["createdAt"]}</strong></li>
-              <li> Deployment deleted at: <strong>{dateAndTime}</strong></li>
-              <li> Deployment status: <strong> {depInfoAndRes["status"]}</strong></li>
-              </ul>
-              </td>
-             </tr>
-            </table>
-          </body>
-        </html>
-        """
- 
+        templateName="DESTROY"
+
     elif eventType=="EXPIRE_NOTIFICATION" and eventTopicId=="deployment.action.pre": #The deployment has expired.
         print("Your deployment has expired")
-        html=f"""\
-        <html>
-          <body>
-          {htmlStyle}
-              {logo}
-              <br>
-              <p><strong>Date and Time:</strong> {dateAndTime}<br></p>
-              <p>Hello <strong> {depInfoAndRes['requestorFirstName']},</strong></p>
-              <p>Your deployment <strong>{depInfoAndRes["name"]}</strong>
-              has expired.</p>
-            <table>
-             <tr>
-              <td>
-              <h2><strong>Deployment Information:</strong></h2>
-              <ul>
-              <li> Deployment name: <strong> {depInfoAndRes["name"]} </strong></li>
-              <li> Deployment Description: <strong> {depInfoAndRes["description"]} </strong></li>
-              <li> Deployment created at: <strong>{depInfoAndRes["createdAt"]}</strong></li>
-              <li> Deployment lease expires: <strong>{depInfoAndRes["leaseExpireAt"]}</strong></li>
-              </ul>
-              </td>
-             </tr>
-            </table>
-          </body>
-        </html>
-        """
+        templateName="EXPIRE"
     else:
         sys.exit("Error: Unrecognized event type!")
+
+    #Building the HTML body.
+    with current_metrics().stage("render") as stage:
+        html=get_template(templateName, sectionOnly).render(values)
+        stage["bytes"]=len(html)
     return html
     
+# Subject of the notification email
+def message_subject(depInfoAndRes):
+    return depInfoAndRes.status+" - Status of deployment "+depInfoAndRes.name+" by "+depInfoAndRes.config.platformName
+
+# Builds the MIME message of a notification: the HTML body plus the cached inline logo.
+def build_message(html, config, recipient, messageSubject):
+    from email.mime.text import MIMEText # mime objects on Email
+    from email.mime.multipart import MIMEMultipart # emails with HTML content
+    started=current_metrics().clock()
+    logoPart=get_logo_part(config) # cached inline logo referenced by cid: in the HTML body
+    message=MIMEMultipart("related") if logoPart else MIMEMultipart("alternative")
+    message["Subject"]=messageSubject
+    message["From"]=config.senderEmail # Sender email address, make sure the Display Name in the account is a friendly name.
+    message["To"]=recipient # Recipient email address
+    
+    # attach the HTML MIME object to the MIMEMultipart message
+    part1=MIMEText(html, "html")
+    message.attach(part1)
+    if logoPart:
+        message.attach(logoPart)
+    current_metrics().add_stage("mime", started)
+    return message
+
+# Opens an SMTP connection with the security mode of the property group (SSL, starttls or none) and logs in when
+# authentication is enabled.
+def open_smtp_connection(config, smtpPassword):
+    import smtplib # send email
+    import ssl # SSL email
+    tlsContext=ssl._create_unverified_context()
+    if config.smtpSecurity=="SSL":
+        print("SSL security")
+        server=smtplib.SMTP_SSL(config.smtpServer, config.smtpPort, context=tlsContext, timeout=smtpTimeout)
+    elif config.smtpSecurity=="starttls":
+        print("starttls security")
+        server=smtplib.SMTP(config.smtpServer, config.smtpPort, timeout=smtpTimeout)
+        server.starttls(context=tlsContext)
+    else:
+        print("non SSL , non starttls security")
+        server=smtplib.SMTP(config.smtpServer, config.smtpPort, timeout=smtpTimeout)
+    if config.smtpAuthenticated:
+        print("authentication enabled")
+        server.login(config.smtpUser, smtpPassword)
+    return server
+
+# SMTP connection kept open between messages while the SMTP settings stay the same.
+class SmtpSession:
+    def __init__(self):
+        self.server=None
+        self.connectionKey=None
+        self.lock=threading.Lock()
+
+    # Closes the connection, if any. A broken connection is dropped without QUIT, which could wait for the timeout again.
+    def close(self, graceful=True):
+        import smtplib # send email
+        if self.server is not None:
+            try:
+                if graceful:
+                    self.server.quit()
+                else:
+                    self.server.close()
+            except (smtplib.SMTPException, OSError):
+                self.server.close()
+        self.server=None
+        self.connectionKey=None
+
+    # Sends an already serialized message. When the server dropped the connection since the last message,
+    # it is reopened and the message sent again. Any error other than an SMTP reply closes the connection, so a
+    # half-broken session (timeout, TLS error) is never reused by the next message.
+    def deliver(self, config, smtpPassword, sender, recipients, messageBytes):
+        import smtplib # send email
+        connectionKey=(config.smtpServer, config.smtpPort, config.smtpSecurity, config.smtpAuthenticated, config.smtpUser,
+            hashlib.sha256(str(smtpPassword).encode()).hexdigest())
+        with self.lock:
+            if self.connectionKey!=connectionKey:
+                self.close()
+            for attempt in (1, 2):
+                reused=self.server is not None
+                if not reused:
+                    self.server=open_smtp_connection(config, smtpPassword)
+                    self.connectionKey=connectionKey
+                try:
+                    return self.server.sendmail(sender, recipients, messageBytes)
+                except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                    raise # the server answered, the connection is still usable
+                except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                    self.close()
+                    if not reused:
+                        raise
+                    print("SMTP connection was closed by the server, reconnecting: "+str(e))
+                except BaseException:
+                    self.close(graceful=False)
+                    raise
+
+smtpSession=SmtpSession() # persistent connection, reused by warm ABX containers
+
+# Sends an already serialized message over the persistent SMTP connection.
+def deliver_message(config, smtpPassword, sender, recipients, messageBytes):
+    return smtpSession.deliver(config, smtpPassword, sender, recipients, messageBytes)
+
 # sends the email notification
 def send_email(context,inputs,html,depInfoAndRes):
+    config=depInfoAndRes.config # settings from the property group
+    message=build_message(html, config, depInfoAndRes.requestorEmail, message_subject(depInfoAndRes))
+    return send_message(context, inputs, config, depInfoAndRes.requestorEmail, message)
+
+# sends a built message to the recipient, returns whether it was delivered
+def send_message(context, inputs, config, recipient, message):
+    import smtplib # send email
         
     # Variables #
-    smtp_port=depInfoAndRes['proGrpContent']['smtp_port']['const'] # smtp_port
-    smtp_server=depInfoAndRes['proGrpContent']['smtp_server']['const'] # FQDN for SMTP
-    smtp_user=depInfoAndRes['proGrpContent']['smtp_user']['const'] # Login to access SMTP Server
     smtp_password=context.getSecret(inputs["smtp_password"]) # gets password from the secrets
-    sender_email=depInfoAndRes['proGrpContent']['sender_email']['const'] # Email Address for Sender, make sure the Display Name in the account is a friendly name.
-    platform_name=depInfoAndRes['proGrpContent']['platform_name']['const'] # To be included in the subject of the email.
-    smtp_auth_enabled=depInfoAndRes['proGrpContent']['smtp_authenticated']['const'] # Is smtp authentication needed
-    smtp_security=depInfoAndRes['proGrpContent']['smtp_connection_security']['const'] # Configure to any of these options (SSL, starttls, none) 
-    myEmail=depInfoAndRes['requestorEmail'] # Requestor's email
     
-    print("sending an email to: "+myEmail)
+    print("sending an email to: "+recipient)
 
-    # Send Email Notification #
-    messageSubject=depInfoAndRes['status']+" - Status of deployment "+depInfoAndRes["name"]+" by "+depInfoAndRes['proGrpContent']['platform_name']['const'] # Subject of the email
-    message=MIMEMultipart("alternative")
-    message["Subject"]=messageSubject
-    message["From"]=sender_email # Sender email address
-    message["To"]=myEmail # Recipient email address
-    
-    # attach the HTML MIME object to the MIMEMultipart message
-    part1=MIMEText(html, "html")
-    message.attach(part1)
+    # the message is serialized only once
+    with current_metrics().stage("serialize") as stage:
+        messageBytes=message.as_bytes()
+        stage["bytes"]=len(messageBytes)
 
     # send email message
     try:
-        context=ssl._create_unverified_context()
-        if smtp_security=="SSL":
-            print("SSL security")
-            with smtplib.SMTP_SSL(smtp_server, smtp_port, context=context) as server:
-                if smtp_auth_enabled:
-                    print("authentication enabled")
-                    server.login(smtp_user, smtp_password)
-                server.sendmail(sender_email, myEmail, message.as_string())
-                server.close()
-        
-        if smtp_security=="starttls":
-            print("starttls security")
-            with smtplib.SMTP(smtp_server, smtp_port) as server:
-                server.starttls(context=context)
-                if smtp_auth_enabled:
-                    print("authentication enabled")
-                    server.login(smtp_user, smtp_password)
-                server.sendmail(sender_email, myEmail, message.as_string())
-                server.close()
-        else:
-           print("non SSL , non starttls security")
-           with smtplib.SMTP(smtp_server, smtp_port) as server:
-                if smtp_auth_enabled:
-                    print("authentication enabled")
-                    server.login(smtp_user, smtp_password)
-                server.sendmail(sender_email, myEmail, message.as_string())
-                server.close()
-
-    except (gaierror, ConnectionRefusedError):
+        with current_metrics().stage("smtp") as stage:
+            deliver_message(config, smtp_password, config.senderEmail, [recipient], messageBytes)
+            stage["bytes"]=len(messageBytes)
+        return True
+    except (socket.gaierror, ConnectionRefusedError):
         print('Failed to connect to the server. Bad connection settings?')
     except smtplib.SMTPServerDisconnected:
         print('Failed to connect to the server. Wrong user/password?')
-    except smtplib.SMTPException as e:
-        print('SMTP error occurred: ' + str(e))
     except smtplib.SMTPAuthenticationError as e:
         print('SMTP Authentication error: ' + str(e))
     except smtplib.SMTPSenderRefused as e:
         print('Sender address refused: ' + str(e))
     except smtplib.SMTPRecipientsRefused as e:
-        print('Recipient addresses refused: ' + str(e))
\ No newline at end of file
+        print('Recipient addresses refused: ' + str(e))
+    except smtplib.SMTPException as e:
+        print('SMTP error occurred: ' + str(e))
+    except OSError as e:
+        print('Failed to connect to the server: ' + str(e))
+    return False
+
+# Degraded notification, sent when vRA can not be queried: a minimal email with the event inputs, built from the
+# cached property group and requestor. Exits when they are not cached, as nothing can be sent then.
+def send_degraded_notification(context, inputs, reason):
+    from html import escape # error text in the notification
+    propGrp=projectCache.get(inputs["vra_fqdn"]+":"+inputs["projectId"])
+    config=propertyGroupCache.get(inputs["vra_fqdn"]+":"+propGrp) if propGrp is not None else None
+    userId=inputs['userId'].split(":")[1]
+    requestor=userCache.get(inputs["orgId"]+":"+userId)
+    if config is None or requestor is None or "unknown" in requestor:
+        sys.exit("Error: "+reason+", and the settings or requestor of the notification are not cached")
+    print("Sending a degraded notification: "+reason)
+    eventType=inputs["eventType"] if "eventType" in inputs else "EXPIRE_NOTIFICATION"
+    logoPart=get_logo_part(config)
+    html=get_template("UNAVAILABLE").render({
+        "logoWidth": config.logoWidth,
+        "logoHeight": config.logoHeight,
+        "logoCid": logoPart["Content-ID"].strip("<>") if logoPart else "",
+        "dateAndTime": datetime.now().astimezone(get_timezone(config.timeZone)).strftime("%Y-%m-%d %H:%M:%S"),
+        "firstName": requestor["firstName"],
+        "platformName": config.platformName,
+        "deploymentId": inputs["deploymentId"],
+        "eventType": eventType,
+        "requestId": inputs["id"] if "id" in inputs else "",
+        "reason": escape(reason),
+        "vraUrl": inputs["vra_fqdn"]
+    })
+    messageSubject=eventType+" - Status of deployment "+inputs["deploymentId"]+" by "+config.platformName
+    message=build_message(html, config, requestor["email"], messageSubject)
+    if "render_only" in inputs and inputs["render_only"]:
+        # render-only mode: the message is built but not sent
+        outputs={'rendered':{"htmlBytes":len(html), "messageBytes":len(message.as_bytes())}}
+    else:
+        outputs=dispatch_message(context, inputs, config, requestor["email"], message)
+    outputs['degraded']=reason
+    outputs['messageSubject']=messageSubject
+    return outputs
+
+# Sends a built message, or spools it when the outbox_dir input is set (outbox mode). Returns the handler outputs.
+def dispatch_message(context, inputs, config, recipient, message):
+    if "outbox_dir" in inputs and inputs["outbox_dir"]:
+        # outbox mode: the message is spooled and delivered later by drain_outbox
+        return {"outbox": spool_message(inputs["outbox_dir"], config, recipient, message)}
+    return {"delivered": send_message(context, inputs, config, recipient, message)}
+
+# Writes a JSON file atomically: readers see either the previous file or the complete new one.
+def write_json_atomic(path, data):
+    tmpPath=path+".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+    with open(tmpPath, "w") as jsonFile:
+        json.dump(data, jsonFile)
+    os.replace(tmpPath, path)
+
+# Number of messages waiting in the outbox (not counting the dead letters).
+def outbox_depth(outboxDir):
+    try:
+        return len([name for name in os.listdir(outboxDir) if name.endswith(".json") or ".json.sending" in name])
+    except FileNotFoundError:
+        return 0
+
+# Outbox mode: writes the fully rendered MIME message and its SMTP settings to the outbox directory, so handler
+# returns without waiting for the SMTP server. The SMTP password is not written, drain_outbox gets it from the secrets.
+def spool_message(outboxDir, config, recipient, message):
+    messageId=uuid.uuid4().hex
+    enqueuedAt=time.time()
+    entry={
+        "id": messageId,
+        "enqueuedAt": enqueuedAt,
+        "attempts": 0,
+        "nextAttemptAt": enqueuedAt,
+        "lastError": None,
+        "sender": config.senderEmail,
+        "recipients": [recipient],
+        "smtp": {"smtpServer":config.smtpServer, "smtpPort":config.smtpPort, "smtpUser":config.smtpUser,
+            "senderEmail":config.senderEmail, "smtpAuthenticated":config.smtpAuthenticated, "smtpSecurity":config.smtpSecurity},
+        "message": base64.b64encode(message.as_bytes()).decode("ascii")
+    }
+    os.makedirs(outboxDir, exist_ok=True)
+    write_json_atomic(os.path.join(outboxDir, "{0:.6f}-{1}.json".format(enqueuedAt, messageId)), entry)
+    queueDepth=outbox_depth(outboxDir)
+    print("Email to "+recipient+" queued in the outbox as "+messageId+", queue depth: "+str(queueDepth))
+    return {"messageId":messageId, "queueDepth":queueDepth}
+
+# Worker entry point of the outbox mode, to be run as its own ABX action (or scheduled) with the same
+# outbox_dir and smtp_password inputs. Delivers the queued messages with outbox_workers concurrent SMTP connections,
+# retries failed ones with exponential backoff and moves them to outbox_dir/dead after outboxMaxAttempts.
+def drain_outbox(context, inputs):
+    import smtplib # send email
+    outboxDir=inputs["outbox_dir"]
+    deadDir=os.path.join(outboxDir, "dead")
+    smtpPassword=context.getSecret(inputs["smtp_password"]) # gets password from the secrets
+    workers=int(inputs["outbox_workers"]) if "outbox_workers" in inputs else outboxWorkers
+    os.makedirs(deadDir, exist_ok=True)
+
+    # queue again the messages claimed by workers that did not finish
+    now=time.time()
+    for name in os.listdir(outboxDir):
+        if ".json.sending" in name and os.path.getmtime(os.path.join(outboxDir, name)) < now-outboxClaimTimeout:
+            print("Queueing again message "+name+" left by a stopped worker")
+            os.replace(os.path.join(outboxDir, name), os.path.join(outboxDir, name.split(".json.sending")[0]+".json"))
+
+    ready=sorted(name for name in os.listdir(outboxDir) if name.endswith(".json"))
+    sessions=[]
+    threadSession=threading.local()
+
+    def deliver_spooled(name):
+        path=os.path.join(outboxDir, name)
+        claimedPath=path+".sending.%d" % os.getpid()
+        try:
+            with open(path) as entryFile:
+                entry=json.load(entryFile)
+            if entry["nextAttemptAt"] > time.time():
+                return "waiting", None
+            os.rename(path, claimedPath) # claims the message, only one worker wins the rename
+        except FileNotFoundError:
+            return "taken", None
+        os.utime(claimedPath)
+        if not hasattr(threadSession, "session"):
+            threadSession.session=SmtpSession()
+            sessions.append(threadSession.session)
+        config=NotificationConfig(content={}, platformName="", timeZone="UTC", **entry["smtp"])
+        try:
+            threadSession.session.deliver(config, smtpPassword, entry["sender"], entry["recipients"], base64.b64decode(entry["message"]))
+        except (smtplib.SMTPException, OSError) as e:
+            entry["attempts"]+=1
+            entry["lastError"]=type(e).__name__+": "+str(e)
+            if entry["attempts"] >= outboxMaxAttempts or isinstance(e, smtplib.SMTPRecipientsRefused):
+                print("Moving message "+entry["id"]+" to the dead letters: "+entry["lastError"])
+                write_json_atomic(os.path.join(deadDir, name), entry)
+                os.remove(claimedPath)
+                return "dead", None
+            delay=min(outboxRetryDelay*2**(entry["attempts"]-1), outboxMaxRetryDelay)
+            entry["nextAttemptAt"]=time.time()+delay*random.uniform(0.5, 1.0)
+            print("Delivery of message "+entry["id"]+" failed (attempt "+str(entry["attempts"])+"), retrying later: "+entry["lastError"])
+            write_json_atomic(path, entry)
+            os.remove(claimedPath)
+            return "retry", None
+        os.remove(claimedPath)
+        return "delivered", time.time()-entry["enqueuedAt"]
+
+    results={"delivered":0, "retry":0, "dead":0, "waiting":0, "taken":0}
+    latencies=[]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for result, latency in executor.map(deliver_spooled, ready):
+            results[result]+=1
+            if latency is not None:
+                latencies.append(round(latency, 3))
+    for session in sessions:
+        session.close()
+
+    outputs={
+        "delivered": results["delivered"],
+        "retried": results["retry"],
+        "deadLettered": results["dead"],
+        "queueDepth": outbox_depth(outboxDir),
+        "deadLetterDepth": len([name for name in os.listdir(deadDir) if name.endswith(".json")]),
+        "deliveryLatencySeconds": latencies
+    }
+    print("Outbox drained: "+json.dumps(outputs))
+    return outputs
+
+# Holds an exclusive lock on a lock file, shared by all the invocations and processes of the node.
+@contextmanager
+def file_lock(path):
+    with open(path, "a") as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+# Reads a JSON file, None when it does not exist.
+def read_json(path):
+    try:
+        with open(path) as jsonFile:
+            return json.load(jsonFile)
+    except FileNotFoundError:
+        return None
+
+# Digest file of a recipient in the digest directory
+def digest_path(digestDir, recipient):
+    return os.path.join(digestDir, hashlib.sha1(recipient.lower().encode()).hexdigest()+".json")
+
+# Renders the digest of a recipient (one section per notification) and sends it, or spools it in outbox mode.
+def send_digest(context, inputs, digest):
+    config=NotificationConfig.from_content(digest["content"])
+    events=digest["events"]
+    logoPart=get_logo_part(config)
+    values={
+        "logoWidth": config.logoWidth,
+        "logoHeight": config.logoHeight,
+        "logoCid": logoPart["Content-ID"].strip("<>") if logoPart else "",
+        "dateAndTime": datetime.now().astimezone(get_timezone(config.timeZone)).strftime("%Y-%m-%d %H:%M:%S"),
+        "firstName": digest["firstName"],
+        "eventCount": len(events),
+        "events": "<hr>".join(event["section"] for event in events)
+    }
+    html=get_template("DIGEST").render(values)
+    messageSubject=events[0]["subject"] if len(events)==1 else str(len(events))+" notifications - Status of your deployments by "+config.platformName
+    message=build_message(html, config, digest["recipient"], messageSubject)
+    return dispatch_message(context, inputs, config, digest["recipient"], message)
+
+# Lock of the digest directory, held while a digest file is read and changed. One lock file for all the recipients.
+def digest_lock(digestDir):
+    return file_lock(os.path.join(digestDir, "digests.lock"))
+
+# Claims a due digest under the digest lock: writes it to a claim file next to the digest and removes the digest, so
+# new notifications of the recipient open a new one meanwhile. The claim is removed once the digest is sent or
+# requeued; flush_digests requeues the claims left by invocations that stopped while sending.
+def claim_digest(path, digest):
+    claimedPath=path+".sending."+uuid.uuid4().hex
+    write_json_atomic(claimedPath, digest)
+    if os.path.exists(path):
+        os.remove(path)
+    return claimedPath
+
+# Puts the events of a claimed digest that could not be sent back in the digest directory, and removes the claim.
+def requeue_digest(path, claimedPath):
+    with digest_lock(os.path.dirname(path)):
+        digest=read_json(claimedPath)
+        if digest is None:
+            return # requeued by another invocation
+        current=read_json(path)
+        if current:
+            current["events"]=digest["events"]+current["events"]
+            current["openedAt"]=min(current["openedAt"], digest["openedAt"])
+            digest=current
+        write_json_atomic(path, digest)
+        os.remove(claimedPath)
+
+# Sends a claimed digest. Its events go back to the digest directory when it is not delivered or the send fails
+# (a missing secret, invalid settings, a full outbox...), the exception is raised again then.
+def send_claimed_digest(context, inputs, path, claimedPath, digest):
+    try:
+        result=send_digest(context, inputs, digest)
+    except BaseException:
+        requeue_digest(path, claimedPath)
+        raise
+    if result.get("delivered") is False:
+        requeue_digest(path, claimedPath)
+    else:
+        os.remove(claimedPath)
+    return result
+
+# Digest mode: adds the notification to the requestor's digest in the digest_dir directory. The first notification
+# opens a window of digest_window_seconds; the digest is sent by the first invocation after the window is over, or by
+# flush_digests. Separate invocations on the node share the digests through the local files.
+def queue_digest(context, inputs, depInfoAndRes):
+    digestDir=inputs["digest_dir"]
+    window=float(inputs["digest_window_seconds"]) if "digest_window_seconds" in inputs else defaultDigestWindow
+    config=depInfoAndRes.config # settings from the property group
+    recipient=depInfoAndRes.requestorEmail
+    section=generate_html(inputs, depInfoAndRes, sectionOnly=True) # the notification without header, for the digest
+    os.makedirs(digestDir, exist_ok=True)
+    path=digest_path(digestDir, recipient)
+    now=time.time()
+    with digest_lock(digestDir):
+        digest=read_json(path) or {"recipient":recipient, "firstName":depInfoAndRes.requestorFirstName, "openedAt":now, "window":window, "events":[]}
+        digest["content"]=config.content # latest settings of the property group
+        digest["events"].append({"subject":message_subject(depInfoAndRes), "section":section, "queuedAt":now})
+        due=now >= digest["openedAt"]+digest["window"]
+        if due:
+            claimedPath=claim_digest(path, digest)
+        else:
+            write_json_atomic(path, digest)
+    print("Notification added to the digest of "+recipient+", "+str(len(digest["events"]))+" notifications in the digest")
+    outputs={"events":len(digest["events"]), "windowEndsAt":digest["openedAt"]+digest["window"], "sent":due}
+    if due:
+        outputs.update(send_claimed_digest(context, inputs, path, claimedPath, digest))
+    return outputs
+
+# Worker entry point of the digest mode, to be scheduled with the same digest_dir and smtp_password inputs: sends
+# the digests whose window is over (all of them with flush_all) so no notification waits for another event.
+def flush_digests(context, inputs):
+    digestDir=inputs["digest_dir"]
+    flushAll=bool(inputs["flush_all"]) if "flush_all" in inputs else False
+    outputs={"digestsSent":0, "eventsSent":0, "digestsPending":0}
+    if not os.path.isdir(digestDir):
+        return outputs
+
+    # requeue the digests claimed by invocations that did not finish, and remove the per recipient lock files of
+    # earlier versions
+    now=time.time()
+    for name in os.listdir(digestDir):
+        claimedPath=os.path.join(digestDir, name)
+        try:
+            if ".json.sending." in name and os.path.getmtime(claimedPath) < now-digestClaimTimeout:
+                print("Queueing again digest "+name+" left by a stopped invocation")
+                requeue_digest(os.path.join(digestDir, name.split(".json.sending.")[0]+".json"), claimedPath)
+            elif name.endswith(".json.lock"):
+                os.remove(claimedPath)
+        except FileNotFoundError:
+            pass # handled by another invocation meanwhile
+
+    for name in sorted(os.listdir(digestDir)):
+        if not name.endswith(".json"):
+            continue
+        path=os.path.join(digestDir, name)
+        with digest_lock(digestDir):
+            digest=read_json(path)
+            due=digest is not None and (flushAll or time.time() >= digest["openedAt"]+digest["window"])
+            if due:
+                claimedPath=claim_digest(path, digest)
+        if digest is None:
+            continue
+        if not due:
+            outputs["digestsPending"]+=1
+            continue
+        result=send_claimed_digest(context, inputs, path, claimedPath, digest)
+        if result.get("delivered") is False:
+            outputs["digestsPending"]+=1
+        else:
+            outputs["digestsSent"]+=1
+            outputs["eventsSent"]+=len(digest["events"])
+    print("Digests flushed: "+json.dumps(outputs))
+    return outputs
@@ -0,0 +1,104 @@
+# Tests of the digest mode: the queued notifications survive a digest that fails to send.
+# Usage: python -m pytest tests
+
+import json # digest files
+import os # paths
+import sys # import path of snippet
+import tempfile # digest directory
+import time # digest windows
+import unittest
+from types import SimpleNamespace # stands in for the notification data of create_dictionary
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snippet # the ABX action
+
+recipient="requestor@example.com"
+
+# Digest of three notifications whose window is over
+def due_digest():
+    openedAt=time.time()-3600
+    return {"recipient": recipient, "firstName": "Requestor", "openedAt": openedAt, "window": 300, "content": {},
+        "events": [{"subject": "event %d" % i, "section": "<p>event %d</p>" % i, "queuedAt": openedAt+i} for i in range(3)]}
+
+class DigestTest(unittest.TestCase):
+    def setUp(self):
+        self.digestDir=tempfile.mkdtemp(prefix="digests-")
+        self.path=snippet.digest_path(self.digestDir, recipient)
+        self.inputs={"digest_dir": self.digestDir, "smtp_password": "smtp_password"}
+
+    def tearDown(self):
+        for name in os.listdir(self.digestDir):
+            os.remove(os.path.join(self.digestDir, name))
+        os.rmdir(self.digestDir)
+
+    def write_digest(self, digest):
+        snippet.write_json_atomic(self.path, digest)
+
+    def read_digest(self):
+        with open(self.path) as digestFile:
+            return json.load(digestFile)
+
+    # files left in the digest directory, apart from the shared lock file
+    def leftovers(self):
+        return sorted(name for name in os.listdir(self.digestDir) if name!="digests.lock")
+
+    def test_flush_requeues_digest_when_send_raises(self):
+        self.write_digest(due_digest())
+        with mock.patch.object(snippet, "send_digest", side_effect=KeyError("smtp_password")):
+            with self.assertRaises(KeyError):
+                snippet.flush_digests(None, self.inputs)
+        self.assertEqual([event["subject"] for event in self.read_digest()["events"]], ["event 0", "event 1", "event 2"])
+        self.assertEqual(self.leftovers(), [os.path.basename(self.path)])
+
+    def test_flush_requeues_digest_when_send_exits(self):
+        self.write_digest(due_digest())
+        with mock.patch.object(snippet, "send_digest", side_effect=SystemExit("Error: invalid settings")):
+            with self.assertRaises(SystemExit):
+                snippet.flush_digests(None, self.inputs)
+        self.assertEqual(len(self.read_digest()["events"]), 3)
+        self.assertEqual(self.leftovers(), [os.path.basename(self.path)])
+
+    def test_flush_requeues_undelivered_digest(self):
+        self.write_digest(due_digest())
+        with mock.patch.object(snippet, "send_digest", return_value={"delivered": False}):
+            outputs=snippet.flush_digests(None, self.inputs)
+        self.assertEqual(outputs["digestsPending"], 1)
+        self.assertEqual(len(self.read_digest()["events"]), 3)
+
+    def test_flush_removes_sent_digest_and_lock_files(self):
+        self.write_digest(due_digest())
+        open(self.path+".lock", "w").close() # per recipient lock file of an earlier version
+        with mock.patch.object(snippet, "send_digest", return_value={"delivered": True}) as send:
+            outputs=snippet.flush_digests(None, self.inputs)
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual((outputs["digestsSent"], outputs["eventsSent"]), (1, 3))
+        self.assertEqual(self.leftovers(), [])
+
+    def test_queue_requeues_digest_with_new_event_when_send_raises(self):
+        self.write_digest(due_digest())
+        depInfoAndRes=SimpleNamespace(config=SimpleNamespace(content={}), requestorEmail=recipient, requestorFirstName="Requestor")
+        with mock.patch.object(snippet, "generate_html", return_value="<p>event 3</p>"), \
+                mock.patch.object(snippet, "message_subject", return_value="event 3"), \
+                mock.patch.object(snippet, "send_digest", side_effect=OSError("outbox is full")):
+            with self.assertRaises(OSError):
+                snippet.queue_digest(None, self.inputs, depInfoAndRes)
+        self.assertEqual(len(self.read_digest()["events"]), 4)
+        self.assertEqual(self.leftovers(), [os.path.basename(self.path)])
+
+    def test_flush_requeues_stale_claim(self):
+        claimedPath=self.path+".sending.stopped"
+        snippet.write_json_atomic(claimedPath, due_digest())
+        os.utime(claimedPath, (time.time()-snippet.digestClaimTimeout-1,)*2)
+        digest=due_digest()
+        digest["openedAt"]=time.time() # a newer digest, opened while the claim was sent
+        digest["events"]=digest["events"][:1]
+        self.write_digest(digest)
+        with mock.patch.object(snippet, "send_digest", return_value={"delivered": True}) as send:
+            snippet.flush_digests(None, dict(self.inputs, flush_all=True))
+        self.assertEqual(len(send.call_args[0][2]["events"]), 4)
+        self.assertEqual(self.leftovers(), [])
+
+if __name__=="__main__":
+    unittest.main()